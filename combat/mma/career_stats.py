@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from fighter_timeline import FighterTimeline
+
+
+class CareerStats:
+    '''
+    Running career totals: prefix sums of per fight stats along the fighter timeline. A fighter's totals over any
+    stretch of their history are the difference of two prefix rows, so the career as of a given fight, or as of any
+    date once it is located on the timeline, is an O(1) lookup.
+
+    Saved with its own copy of the timeline so totals as of a future date can be served without the stage files.
+    '''
+    def __init__(self, timeline, prefix_sums, stat_names):
+        self.timeline = timeline
+        self.prefix_sums = prefix_sums
+        self.stat_names = list(stat_names)
+
+    @classmethod
+    def from_frame(cls, df, timeline, stat_names):
+        values = timeline.take(df[stat_names].to_numpy(dtype=np.float64))
+        prefix_sums = np.vstack([np.zeros((1, len(stat_names))), np.cumsum(np.nan_to_num(values), axis=0)])
+        return cls(timeline, prefix_sums, stat_names)
+
+    def save(self, folder):
+        self.timeline.save(folder)
+        np.save(f'{folder}/prefix_sums.npy', self.prefix_sums)
+        pd.DataFrame({'stat_name': self.stat_names}).to_csv(f'{folder}/stat_names.csv', sep='|', index=False)
+
+    @classmethod
+    def load(cls, folder):
+        stat_names = pd.read_csv(f'{folder}/stat_names.csv', sep='|')['stat_name'].tolist()
+        return cls(FighterTimeline.load(folder), np.load(f'{folder}/prefix_sums.npy', mmap_mode='r'), stat_names)
+
+    def get_totals(self, starts, ends):
+        return pd.DataFrame(self.prefix_sums[ends] - self.prefix_sums[starts], columns=self.stat_names)
+
+    def get_before_each_fight(self):
+        '''
+        Totals over each fighter's earlier fights, for every record in the order of the frame the timeline points at.
+        '''
+        totals = self.get_totals(self.timeline.get_group_starts(), np.arange(len(self.timeline)))
+        return totals.iloc[np.argsort(self.timeline.order)].reset_index(drop=True)
+
+    def get_as_of(self, fighter_ids, dates):
+        '''
+        Totals over every fight each fighter had strictly before the matching date, zeros for unknown fighters.
+        '''
+        fighter_ids = np.asarray(fighter_ids).astype(np.int64)
+        dates = pd.Series(dates) if np.ndim(dates) else pd.Series([dates] * len(fighter_ids))
+        positions = self.timeline.get_last_position_before(fighter_ids, dates)
+        found = positions >= 0
+        starts = np.where(found, self.timeline.offsets[np.where(found, fighter_ids, 0)], 0)
+        ends = np.where(found, positions + 1, 0)
+        return self.get_totals(starts, ends)
@@ -19,9 +19,15 @@ def parse_list_of_ints_from_str(s):
     return [int(i) for i in re.findall('\d+', str(s))]
 
 
+punctuation_table = str.maketrans('', '', string.punctuation)
+
+
 def clean_text(s):
-    exclude = set(string.punctuation)
-    return ''.join([i for i in str(s).lower() if i not in exclude])
+    return str(s).lower().translate(punctuation_table)
+
+
+def clean_text_column(s):
+    return s.str.lower().str.translate(punctuation_table)
 
 
 def sleep_on_error():
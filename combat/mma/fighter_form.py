@@ -0,0 +1,105 @@
+import numpy as np
+import os
+
+from fighter_timeline import get_date_keys, missing_date_key
+
+nanoseconds_per_day = 24 * 60 * 60 * 10 ** 9
+
+
+class FighterForm:
+    '''
+    Exponentially time decayed sums of per fight stats for every fighter, one set per half life (in days).
+
+    The state per fighter is the date of their last fight plus the decayed sums and weights, so adding a fight is an
+    O(1) update and current form is read without going back to the fight history. A fighter's form is the decayed
+    mean of each stat, and the decayed number of fights measures how active they have been.
+    '''
+    def __init__(self, half_lives, stat_names, fighter_count=0):
+        self.half_lives = np.asarray(half_lives, dtype=np.float64)
+        self.stat_names = list(stat_names)
+        self.last_days = np.full(fighter_count, np.nan)
+        self.sums = np.zeros((fighter_count, len(self.half_lives), len(self.stat_names)))
+        self.weights = np.zeros((fighter_count, len(self.half_lives), len(self.stat_names)))
+        self.fight_weights = np.zeros((fighter_count, len(self.half_lives)))
+
+    def ensure_fighters(self, fighter_count):
+        extra = fighter_count - len(self.last_days)
+        if extra <= 0:
+            return
+        self.last_days = np.concatenate([self.last_days, np.full(extra, np.nan)])
+        self.sums = np.concatenate([self.sums, np.zeros((extra,) + self.sums.shape[1:])])
+        self.weights = np.concatenate([self.weights, np.zeros((extra,) + self.weights.shape[1:])])
+        self.fight_weights = np.concatenate([self.fight_weights, np.zeros((extra,) + self.fight_weights.shape[1:])])
+
+    def get_decay(self, fighter_ids, days):
+        elapsed = np.clip(days - self.last_days[fighter_ids], 0, None)
+        decay = 0.5 ** (elapsed[:, None] / self.half_lives[None, :])
+        return np.where(np.isnan(decay), 1.0, decay)
+
+    def read(self, fighter_ids, days):
+        '''
+        Decayed means, shape (fighters, half lives, stats), and decayed fight counts, shape (fighters, half lives),
+        as of the given days. Each fighter id may appear once.
+        '''
+        self.ensure_fighters(np.max(fighter_ids, initial=-1) + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums[fighter_ids] / self.weights[fighter_ids]
+        return means, self.fight_weights[fighter_ids] * self.get_decay(fighter_ids, days)
+
+    def update(self, fighter_ids, days, values):
+        '''
+        Adds one fight per fighter. values has shape (fighters, stats), missing values leave that stat's sums alone.
+        '''
+        self.ensure_fighters(np.max(fighter_ids, initial=-1) + 1)
+        decay = self.get_decay(fighter_ids, days)
+        valid = ~np.isnan(values)
+        self.sums[fighter_ids] = self.sums[fighter_ids] * decay[:, :, None] + np.where(valid, values, 0)[:, None, :]
+        self.weights[fighter_ids] = self.weights[fighter_ids] * decay[:, :, None] + valid[:, None, :]
+        self.fight_weights[fighter_ids] = self.fight_weights[fighter_ids] * decay + 1
+        self.last_days[fighter_ids] = np.where(np.isnan(days), self.last_days[fighter_ids], days)
+
+    def update_from_timeline(self, timeline, values):
+        '''
+        Feeds every fight on the timeline through the state in date order and returns the form before each fight,
+        (means, fight counts) in timeline order. Each step takes the k-th fight of every fighter at once, so the
+        python loop runs once per fight of the longest career.
+        '''
+        values = timeline.take(values)
+        days = get_days(timeline.dates)
+        positions = timeline.get_positions()
+        entries_by_position = np.argsort(positions, kind='stable')
+        position_starts = np.searchsorted(positions[entries_by_position], np.arange(positions.max(initial=-1) + 2))
+
+        means = np.full((len(timeline), len(self.half_lives), len(self.stat_names)), np.nan)
+        fight_counts = np.zeros((len(timeline), len(self.half_lives)))
+        for k in range(len(position_starts) - 1):
+            entries = entries_by_position[position_starts[k]:position_starts[k + 1]]
+            fighter_ids = timeline.fighter_ids[entries]
+            means[entries], fight_counts[entries] = self.read(fighter_ids, days[entries])
+            self.update(fighter_ids, days[entries], values[entries])
+        return means, fight_counts
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        np.savez(path, half_lives=self.half_lives, stat_names=np.array(self.stat_names), last_days=self.last_days,
+                 sums=self.sums, weights=self.weights, fight_weights=self.fight_weights)
+
+    @classmethod
+    def load(cls, path):
+        saved = np.load(path)
+        form = cls(saved['half_lives'], saved['stat_names'].tolist())
+        form.last_days = saved['last_days']
+        form.sums = saved['sums']
+        form.weights = saved['weights']
+        form.fight_weights = saved['fight_weights']
+        return form
+
+
+def get_days(dates):
+    '''
+    Days since the epoch as floats, NaN for missing dates. Takes dates or the int64 keys from get_date_keys.
+    '''
+    date_keys = np.asarray(dates) if np.asarray(dates).dtype == np.int64 else get_date_keys(dates)
+    return np.where(date_keys == missing_date_key, np.nan, date_keys / nanoseconds_per_day)
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+import os
+
+
+class FighterTimeline:
+    '''
+    Every fight record ordered by fighter and then date, kept as flat arrays with per fighter offsets (CSR layout).
+    Timeline entries offsets[f]:offsets[f + 1] are fighter f's fights in date order, and order maps each entry back
+    to its row in the frame the timeline was built from.
+
+    Fighter ids are the dense interned ints, so a fighter's slice is a direct lookup in offsets. Fights on the same
+    date keep their frame order and missing dates go last. A saved timeline is loaded memory mapped, so builders
+    running at the same time share one copy.
+    '''
+    array_names = ['order', 'fighter_ids', 'dates', 'record_ids', 'offsets']
+
+    def __init__(self, order, fighter_ids, dates, record_ids, offsets):
+        self.order = order
+        self.fighter_ids = fighter_ids
+        self.dates = dates
+        self.record_ids = record_ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_frame(cls, df, fighter_column='fighter_id', date_column='fight_dt', record_column='record_id'):
+        fighter_ids = df[fighter_column].to_numpy().astype(np.int64)
+        dates = get_date_keys(df[date_column])
+        order = np.lexsort((dates, fighter_ids))
+        fighter_ids = fighter_ids[order]
+        offsets = np.searchsorted(fighter_ids, np.arange(fighter_ids.max() + 2 if len(fighter_ids) else 1))
+        if record_column in df.columns:
+            record_ids = df[record_column].to_numpy()[order]
+        else:
+            record_ids = np.arange(len(order))
+        return cls(order, fighter_ids, dates[order], record_ids, offsets)
+
+    def save(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for name in self.array_names:
+            np.save(f'{folder}/{name}.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, folder):
+        return cls(*[np.load(f'{folder}/{name}.npy', mmap_mode='r') for name in cls.array_names])
+
+    def align(self, record_ids):
+        '''
+        Same timeline pointing at the rows of a frame holding the same records in another order, None if the frame
+        does not hold exactly these records.
+        '''
+        record_ids = np.asarray(record_ids)
+        if len(record_ids) != len(self.order):
+            return None
+        if np.array_equal(record_ids[self.order], self.record_ids):
+            return self
+        record_index = pd.Index(record_ids)
+        if not record_index.is_unique:
+            return None
+        order = record_index.get_indexer(self.record_ids)
+        if (order == -1).any():
+            return None
+        return FighterTimeline(order, self.fighter_ids, self.dates, self.record_ids, self.offsets)
+
+    def __len__(self):
+        return len(self.order)
+
+    def get_fighter_slice(self, fighter_id):
+        if fighter_id < 0 or fighter_id + 1 >= len(self.offsets):
+            return slice(0, 0)
+        return slice(self.offsets[fighter_id], self.offsets[fighter_id + 1])
+
+    def get_fighter_rows(self, fighter_id):
+        '''
+        Frame rows of the fighter's fights in date order.
+        '''
+        return self.order[self.get_fighter_slice(fighter_id)]
+
+    def get_group_starts(self):
+        return self.offsets[self.fighter_ids]
+
+    def get_positions(self):
+        '''
+        Position of each timeline entry in its fighter's history, 0 for a fighter's first fight.
+        '''
+        return np.arange(len(self.order)) - self.get_group_starts()
+
+    def take(self, values):
+        '''
+        Frame ordered values to timeline order.
+        '''
+        return np.asarray(values)[self.order]
+
+    def to_frame_order(self, values):
+        values = np.asarray(values)
+        output = np.empty_like(values)
+        output[self.order] = values
+        return output
+
+    def diff(self, values):
+        '''
+        Difference to the fighter's previous timeline entry, missing for a fighter's first fight.
+        '''
+        return pd.Series(values).diff().mask(self.get_positions() == 0).to_numpy()
+
+    def forward_fill(self, values):
+        '''
+        Fills missing values with the fighter's last earlier non missing value.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        last_valid = np.where(~np.isnan(values), np.arange(len(values)), -1)
+        np.maximum.accumulate(last_valid, out=last_valid)
+        last_valid[last_valid < self.get_group_starts()] = -1
+        return np.where(last_valid >= 0, values[np.maximum(last_valid, 0)], np.nan)
+
+    def get_last_position_before(self, fighter_ids, dates):
+        '''
+        Timeline position of each fighter's most recent entry dated strictly before the matching date, -1 if there is
+        none.
+        '''
+        fighter_ids = np.asarray(fighter_ids).astype(np.int64)
+        date_keys = get_date_keys(dates)
+        known_fighters = (fighter_ids >= 0) & (fighter_ids + 1 < len(self.offsets))
+        clipped_ids = np.where(known_fighters, fighter_ids, 0)
+
+        # (fighter, date rank) as one sortable int so a single searchsorted covers every fighter's slice
+        unique_dates = np.unique(self.dates)
+        timeline_keys = self.fighter_ids * (len(unique_dates) + 1) + np.searchsorted(unique_dates, self.dates)
+        query_keys = clipped_ids * (len(unique_dates) + 1) + np.searchsorted(unique_dates, date_keys)
+        positions = np.searchsorted(timeline_keys, query_keys, side='left') - 1
+
+        found = known_fighters & (date_keys != missing_date_key) & (positions >= self.offsets[clipped_ids])
+        return np.where(found, positions, -1)
+
+    def get_last_before(self, fighter_ids, dates):
+        '''
+        Frame row of each fighter's most recent record dated strictly before the matching date, -1 if there is none.
+        '''
+        positions = self.get_last_position_before(fighter_ids, dates)
+        return np.where(positions >= 0, self.order[np.maximum(positions, 0)], -1)
+
+
+missing_date_key = np.iinfo(np.int64).max
+
+
+def get_date_keys(dates):
+    '''
+    Dates as int64 nanoseconds with missing dates sorting last.
+    '''
+    dates = pd.to_datetime(pd.Series(dates), errors='coerce')
+    return np.where(dates.isna(), missing_date_key, dates.to_numpy().astype('datetime64[ns]').astype(np.int64))
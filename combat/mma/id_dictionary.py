@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import os
+
+
+class IdDictionary:
+    '''
+    Persistent mapping of string keys (fighter urls, hashed record/fight keys) to dense integer ids.
+
+    Ids are assigned in order of first appearance and never change once saved, so a dictionary can be reloaded and
+    extended by later runs. The strings are only kept in the dictionary, every pipeline stage works on the ints.
+
+    Lookups go through a dict that only gets the new keys appended, so encoding a batch costs time in the batch size
+    and not in the number of keys seen so far. Memory grows with the number of distinct keys (one entry per record
+    for the record dictionary), not with the batch size.
+    '''
+    def __init__(self, path, dtype=np.int32):
+        self.path = path
+        self.dtype = dtype
+        if os.path.exists(path):
+            lookup_df = pd.read_csv(path, sep='|', dtype={'key': str}, keep_default_na=False)
+            self.keys = lookup_df.sort_values('int_id')['key'].tolist()
+        else:
+            self.keys = []
+        self.codes = {k: n for n, k in enumerate(self.keys)}
+
+    def encode(self, s, add_keys=True):
+        '''
+        :param add_keys: assign ids to unseen keys, otherwise they are encoded as -1
+        '''
+        values = pd.Series(s).astype(object).fillna('nan').astype(str).values
+        value_codes, unique_values = pd.factorize(values)
+        unique_codes = np.fromiter((self.codes.get(k, -1) for k in unique_values), dtype=np.int64,
+                                   count=len(unique_values))
+        if add_keys and (unique_codes == -1).any():
+            # factorize keeps first appearance order, so new keys get their ids in that order
+            new_keys = unique_values[unique_codes == -1].tolist()
+            unique_codes[unique_codes == -1] = np.arange(len(self.keys), len(self.keys) + len(new_keys))
+            self.codes.update(zip(new_keys, range(len(self.keys), len(self.keys) + len(new_keys))))
+            self.keys.extend(new_keys)
+        return unique_codes[value_codes].astype(self.dtype)
+
+    def decode(self, codes):
+        return np.array(self.keys, dtype=object)[np.asarray(codes)]
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        lookup_df = pd.DataFrame({'int_id': np.arange(len(self.keys), dtype=self.dtype), 'key': self.keys})
+        lookup_df.to_csv(self.path, sep='|', index=False)
+
+    def __len__(self):
+        return len(self.keys)
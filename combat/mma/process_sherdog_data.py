@@ -3,44 +3,256 @@ import pandas as pd
 from sherdog_scraper import (base_output_folder,
                              run_scrape
                              )
-from common import (parse_list_of_ints_from_str,
-                    clean_text,
+from id_dictionary import IdDictionary
+from fighter_timeline import FighterTimeline
+from career_stats import CareerStats
+from fighter_form import FighterForm, get_days
+from stage_runner import run_stage_graph
+from common import (clean_text,
+                    clean_text_column,
                     get_new_rating,
                     starting_rating)
-import datetime
 import tqdm
 import functools
 import operator
-from sklearn.preprocessing import LabelEncoder
 import pickle
 import os
+import hashlib
+import shutil
 from scipy import stats
 from sklearn.ensemble import RandomForestRegressor
 import uuid
 import time
+import numpy as np
+import re
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 
 nan_cat = 'nan_cat'
+id_mode_hash = 'hash'
+id_mode_uuid = 'uuid'
+
+# low cardinality text columns, kept as categoricals so text transforms run once per distinct value
+raw_fight_categorical_columns = ['event_name', 'method', 'fight_type_text', 'referee', 'result']
+raw_personal_categorical_columns = ['nationality']
+processed_fight_categorical_columns = ['event_org', 'general_method', 'method_details', 'method', 'fight_type']
+
+id_dictionary_folder = 'id_dictionaries'
+fighter_timeline_folder = 'fighter_timeline'
+category_code_prefix = 'category_'
+career_stats_folder = 'career_stats'
+career_stat_names = ['fights', 'wins', 'losses', 'ko', 'submission', 'decision', 'cage_time']
+fighter_form_file_name = 'fighter_form.npz'
+mirror_rows_file_name = 'mirror_rows.npy'
+# merged_fight_data columns the fighter timeline and the mirror rows are built from
+merge_index_columns = ['record_id', 'fight_id', 'fighter_id', 'opponent_id', 'fight_dt']
+chunk_check_folder = 'chunk_check'
+feature_evaluation_n_jobs = -1
+feature_evaluation_max_samples = 100000
+initial_feature_stage_names = ['personal_features', 'date_features', 'fight_timing_features', 'rematch_features',
+                               'fighter_ratings', 'career_features', 'form_features']
+form_stat_names = ['result', 'ko', 'submission', 'decision', 'fight_end_time']
+form_half_lives = [90, 365, 1095]
+# interned id column -> (dictionary name, int dtype), fighter and opponent ids share one dictionary
+interned_id_columns = {'fighter_id': ('fighter', np.int32),
+                       'opponent_id': ('fighter', np.int32),
+                       'fight_id': ('fight', np.int64),
+                       'record_id': ('record', np.int64),
+                       'fighter_matchup_id': ('fighter_matchup', np.int64)}
+
+
+stage_file_format = 'parquet'
+# stages read by several feature builders running at once are kept as uncompressed arrow files. The processes memory
+# map them and read their columns without decoding parquet, and the file pages are shared through the os page cache,
+# but converting to pandas still copies the columns each process reads into that process
+memory_mapped_stage_format = 'arrow'
+memory_mapped_stage_names = ['merged_fight_data']
+# processes for run_data_pipeline, enough for the rating stage and the initial feature builders to run at once
+pipeline_max_workers = min(7, os.cpu_count() or 1)
+export_stage_csv = False
+final_stage_names = ['final_features', 'final_target']
+# set while run_stages_in_memory is running: stage name -> DataFrame, and the stage names that still go to disk
+in_memory_stage_data = None
+in_memory_persisted_stages = set()
+
+processed_fighter_schema = {'fighter_id': 'int32',
+                            'nationality': 'category',
+                            'birth_dt': 'datetime64[ns]',
+                            'height_m': 'float32',
+                            'weight_m': 'float32',
+                            'name': 'category'}
+processed_fight_schema = {'event_org': 'category',
+                          'fight_dt': 'datetime64[ns]',
+                          'round_end_time': 'float32',
+                          'fight_end_time': 'float32',
+                          'general_method': 'category',
+                          'method_details': 'category',
+                          'method': 'category',
+                          'fight_type': 'category',
+                          'fighter_id': 'int32',
+                          'opponent_id': 'int32',
+                          'result': 'float32',
+                          'fight_id': 'int64',
+                          'record_id': 'int64',
+                          'fighter_matchup_id': 'int64'}
+merged_fight_schema = dict(processed_fight_schema)
+merged_fight_schema.update({f'{p}_{c}': t for c, t in processed_fighter_schema.items() if c != 'fighter_id'
+                            for p in ['fighter', 'opponent']})
+stage_schemas = {'processed_fighter_data': processed_fighter_schema,
+                 'processed_fight_data': processed_fight_schema,
+                 'merged_fight_data': merged_fight_schema}
+# columns without a declared dtype: floats are stored as float32 and ints other than the ids are downcast to the
+# smallest int type holding them (int8 flags and rounds, int16 years and codes)
+compact_float_dtype = 'float32'
 
 
 #######################################################################################################################
-# Data cleaning
+# Stage storage
 
 
-def convert_height_to_metric(s):
-    m_per_ft = .3048
-    m_per_in = .0254
+def apply_stage_schema(df, name):
+    schema = stage_schemas.get(name, dict())
+    dtypes = {c: dtype for c, dtype in schema.items() if c in df.columns and str(df[c].dtype) != dtype}
+    for c in df.columns:
+        if c in schema or c.endswith('_id'):
+            continue
+        if df[c].dtype == np.float64:
+            dtypes[c] = compact_float_dtype
+        elif df[c].dtype == np.int64:
+            dtypes[c] = pd.to_numeric(df[c], downcast='integer').dtype
+    return df.astype(dtypes, copy=False) if dtypes else df
 
-    component_list = parse_list_of_ints_from_str(s)
-    if len(component_list) == 2:
-        return m_per_ft * component_list[0] + m_per_in * component_list[1]
 
+def get_memory_usage_mb(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
 
-def convert_weight_to_metric(s):
-    kg_per_lb = 0.453592
 
-    component_list = parse_list_of_ints_from_str(s)
-    if len(component_list) == 1:
-        return kg_per_lb * component_list[0]
+def print_stage_memory_usage(df, name):
+    print(f'stage {name} {df.shape}: {get_memory_usage_mb(df):.2f} MB in memory')
+
+
+def get_stage_format(name):
+    return memory_mapped_stage_format if name in memory_mapped_stage_names else stage_file_format
+
+
+def get_stage_path(output_folder, name):
+    return f'{output_folder}/{name}.{get_stage_format(name)}'
+
+
+def save_stage_data(df, output_folder, name, export_csv=None):
+    '''
+    Writes a stage output as a typed columnar file (parquet) using the stage's declared schema, and prints the
+    frame's memory footprint.
+    A pipe delimited csv copy is written as well when export_csv (or export_stage_csv) is set.
+    In memory mode the frame is kept for the next stages and only written if the stage is persisted.
+    '''
+    df = apply_stage_schema(df, name)
+    print_stage_memory_usage(df, name)
+    if in_memory_stage_data is not None:
+        in_memory_stage_data[name] = df
+        if name not in in_memory_persisted_stages:
+            return
+    if get_stage_format(name) == memory_mapped_stage_format:
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), get_stage_path(output_folder, name),
+                              compression='uncompressed')
+    else:
+        df.to_parquet(get_stage_path(output_folder, name), index=False)
+
+    if export_csv or (export_csv is None and export_stage_csv):
+        df.to_csv(f'{output_folder}/{name}.csv', sep='|', index=False)
+
+
+def load_stage_data(output_folder, name, columns=None):
+    '''
+    :param columns: only these columns are read from disk
+    '''
+    if in_memory_stage_data is not None and name in in_memory_stage_data:
+        # copied since stages modify their inputs in place
+        df = in_memory_stage_data[name]
+        return (df[columns] if columns else df).copy()
+    if get_stage_format(name) == memory_mapped_stage_format:
+        df = read_memory_mapped_stage(get_stage_path(output_folder, name), name, columns=columns)
+    else:
+        df = pd.read_parquet(get_stage_path(output_folder, name), columns=columns)
+    return apply_stage_schema(df, name)
+
+
+def read_memory_mapped_stage(path, name, columns=None):
+    '''
+    Arrow stages written in chunks hold their categoricals as plain strings (see StageWriter), these are dictionary
+    encoded in arrow before converting to pandas.
+    '''
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    schema = stage_schemas.get(name, dict())
+    for n, field in enumerate(table.schema):
+        if schema.get(field.name) == 'category' and pa.types.is_string(field.type):
+            table = table.set_column(n, field.name, table.column(n).dictionary_encode())
+    return table.unify_dictionaries().to_pandas()
+
+
+class StageWriter:
+    '''
+    Writes a stage in chunks. The schema comes from the first chunk, with categoricals, all-null columns and
+    undeclared ints widened to int32 coded / plain strings / int64 so later chunks with other values fit it. The
+    ints are downcast again when the stage is loaded.
+
+    Arrow IPC files allow a single dictionary per column across all batches, so arrow stages store the categoricals
+    as plain strings instead, and read_memory_mapped_stage encodes them again.
+    '''
+    def __init__(self, output_folder, name):
+        self.path = get_stage_path(output_folder, name)
+        self.name = name
+        self.schema = None
+        self.writer = None
+        self.row_count = 0
+        self.memory_usage_mb = 0
+
+    def open(self, df):
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        declared_columns = stage_schemas.get(self.name, dict())
+        for n, field in enumerate(schema):
+            if pa.types.is_dictionary(field.type) and get_stage_format(self.name) == memory_mapped_stage_format:
+                schema = schema.set(n, pa.field(field.name, pa.string()))
+            elif pa.types.is_dictionary(field.type):
+                schema = schema.set(n, pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+            elif pa.types.is_null(field.type):
+                schema = schema.set(n, pa.field(field.name, pa.string()))
+            elif pa.types.is_integer(field.type) and field.name not in declared_columns:
+                schema = schema.set(n, pa.field(field.name, pa.int64()))
+        self.schema = schema
+        if get_stage_format(self.name) == memory_mapped_stage_format:
+            self.writer = pa.ipc.new_file(self.path, schema)
+        else:
+            self.writer = pq.ParquetWriter(self.path, schema)
+
+    def write(self, df):
+        df = apply_stage_schema(df, self.name)
+        if self.writer is None:
+            self.open(df)
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.row_count += df.shape[0]
+        self.memory_usage_mb = max(self.memory_usage_mb, get_memory_usage_mb(df))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        print(f'stage {self.name} ({self.row_count} rows): {self.memory_usage_mb:.2f} MB in memory per chunk')
+
+
+def iter_stage_data_chunks(output_folder, name, chunk_size, columns=None):
+    parquet_file = pq.ParquetFile(get_stage_path(output_folder, name))
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        yield apply_stage_schema(batch.to_pandas(), name)
+
+
+def export_stage_to_csv(run_id, name):
+    output_folder = f'{base_output_folder}/{run_id}'
+    load_stage_data(output_folder, name).to_csv(f'{output_folder}/{name}.csv', sep='|', index=False)
+
+
+#######################################################################################################################
+# Data cleaning
 
 
 def clean_name(s):
@@ -65,115 +277,184 @@ def get_event_org(event_s):
     return ' '.join(event_split[:-1])
 
 
-def parse_event_date(s):
-    month_map = {'Jan': 1,
-                 'Feb': 2,
-                 'Mar': 3,
-                 'Apr': 4,
-                 'May': 5,
-                 'Jun': 6,
-                 'Jul': 7,
-                 'Aug': 8,
-                 'Sep': 9,
-                 'Oct': 10,
-                 'Nov': 11,
-                 'Dec': 12,
-                 }
-
-    split_date = str(s).split('/')
-    if len(split_date) == 3:
-        try:
-            month_num = month_map[split_date[0].strip()]
-            return datetime.datetime(int(split_date[2]), month_num, int(split_date[1]))
-        except ValueError:
-            pass
-
-
-def extract_fight_end_time(end_round, round_end_time):
-    assumed_round_time = 300
-    seconds_per_min = 60
+def get_value_reprs(s):
+    codes, uniques = pd.factorize(s)
+    reprs = np.array([repr(i) for i in uniques.tolist()] + ['nan'], dtype=object)
+    return reprs[codes]
+
+
+def build_uuid_ids(df, columns, sort_values=False):
+    '''
+    Reproduces uuid.uuid5(uuid.NAMESPACE_DNS, str([...])).hex over the given columns, building the list strings
+    for the whole column at once instead of per row.
+    '''
+    values = np.stack([df[c].values.astype(object) for c in columns], axis=1)
+    reprs = np.stack([get_value_reprs(df[c]) for c in columns], axis=1)
+    if sort_values:
+        order = np.argsort(values.astype(str), axis=1, kind='stable')
+        reprs = np.take_along_axis(reprs, order, axis=1)
+
+    names = pd.Series(reprs[:, 0], index=df.index)
+    for i in range(1, len(columns)):
+        names = names + ', ' + reprs[:, i]
+    names = '[' + names + ']'
+    return [uuid.uuid5(uuid.NAMESPACE_DNS, n).hex for n in names]
+
+
+def build_hash_ids(df, columns, sort_values=False):
+    '''
+    64 bit hex ids from pandas' vectorized column hashing, combined across columns. With sort_values the id does not
+    depend on column order.
+    '''
+    hashes = np.stack([pd.util.hash_array(df[c].astype(str).values) for c in columns], axis=1)
+    if sort_values:
+        hashes = np.sort(hashes, axis=1)
+
+    combined = np.full(df.shape[0], len(columns), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(len(columns)):
+            combined = combined * np.uint64(1000003) ^ hashes[:, i]
+            combined ^= combined >> np.uint64(29)
+            combined *= np.uint64(0xbf58476d1ce4e5b9)
+            combined ^= combined >> np.uint64(32)
+    return ['{:016x}'.format(i) for i in combined.tolist()]
+
+
+def build_ids(df, columns, sort_values=False, id_mode=id_mode_hash):
+    if id_mode == id_mode_uuid:
+        return build_uuid_ids(df, columns, sort_values=sort_values)
+    if id_mode == id_mode_hash:
+        return build_hash_ids(df, columns, sort_values=sort_values)
+    raise ValueError(f'invalid id_mode: {id_mode}')
+
+
+two_int_pattern = re.compile(r'^\D*(\d+)\D+(\d+)\D*$')
+one_int_pattern = re.compile(r'^\D*(\d+)\D*$')
+event_date_pattern = re.compile(r'^\s*(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\s*/\s*(\d+)\s*/\s*(\d+)\s*$')
+
+
+# Column versions of the parsers above, these give the same values for a whole column at once.
+# The raw text columns repeat a few thousand distinct values, so parsing is done once per distinct value.
+
+
+def map_unique_values(s, func):
+    codes, uniques = pd.factorize(s)
+    # missing values get code -1, which picks func's output for nan at the end
+    out = func(pd.Series(list(uniques) + [np.nan], dtype=object)).iloc[codes]
+    out.index = s.index
+    return out
+
+
+def map_categories(s, func):
+    '''
+    Runs a column function over the categories of s only and returns the result as a categorical with the same
+    codes layout, so text transforms cost O(distinct values) and the output stays compact.
+    '''
+    s = s.astype('category')
+    mapped = pd.Categorical(func(pd.Series(list(s.cat.categories) + [np.nan], dtype=object)).values)
+    # missing values have code -1, which picks func's output for nan at the end
+    codes = mapped.codes[s.cat.codes.values]
+    return pd.Series(pd.Categorical.from_codes(codes, mapped.categories), index=s.index)
+
 
-    components = parse_list_of_ints_from_str(round_end_time)
-    if len(components) == 2:
-        round_end_time_s = seconds_per_min * components[0] + components[1]
-        finished_rounds = end_round - 1
-        time_of_previous_rounds = assumed_round_time * finished_rounds
-        return round_end_time_s + time_of_previous_rounds
+def extract_ints(s, pattern):
+    return s.astype(str).str.extract(pattern).astype(float)
 
 
-def extract_round_end_time(round_end_time):
+def convert_height_to_metric_column(s):
+    m_per_ft = .3048
+    m_per_in = .0254
+
+    components = extract_ints(s, two_int_pattern)
+    return m_per_ft * components[0] + m_per_in * components[1]
+
+
+def convert_weight_to_metric_column(s):
+    kg_per_lb = 0.453592
+
+    components = extract_ints(s, one_int_pattern)
+    return kg_per_lb * components[0]
+
+
+def parse_event_date_column(s):
+    components = s.astype(str).str.extract(event_date_pattern)
+    date_str = components[2].str.zfill(4) + '-' + components[0] + '-' + components[1].str.zfill(2)
+    return pd.to_datetime(date_str, format='%Y-%b-%d', errors='coerce')
+
+
+def extract_round_end_time_column(round_end_time):
     seconds_per_min = 60
 
-    components = parse_list_of_ints_from_str(round_end_time)
-    if len(components) == 2:
-        round_end_time_s = seconds_per_min * components[0] + components[1]
-        return round_end_time_s
+    components = extract_ints(round_end_time, two_int_pattern)
+    return seconds_per_min * components[0] + components[1]
 
 
-def extract_general_method(s):
-    split_method = str(s).split('(')
-    if len(split_method) >= 2:
-        clean_method = clean_text(split_method[0])
-    else:
-        clean_method = clean_text(s)
-
-    if 'tko' in clean_method or 'ko' in clean_method:
-        return 'ko'
-    elif 'submission' in clean_method:
-        return 'submission'
-    elif 'decision' in clean_method:
-        return 'decision'
-    else:
-        return 'other'
+def extract_fight_end_time_column(end_round, round_end_time_s):
+    assumed_round_time = 300
+
+    finished_rounds = pd.to_numeric(end_round) - 1
+    return round_end_time_s + assumed_round_time * finished_rounds
+
+
+def split_method_column(s):
+    split_method = s.astype(str).str.split('(', n=1, expand=True)
+    if split_method.shape[1] == 1:
+        split_method[1] = np.nan
+    return split_method[0], split_method[1]
+
 
+def extract_general_method_column(s):
+    before_details, details = split_method_column(s)
+    clean_method = clean_text_column(before_details)
 
-def extract_method(s):
-    split_method = str(s).split('(')
-    if len(split_method) >= 2:
-        clean_method = clean_text(split_method[0])
-        return clean_method
+    return pd.Series(np.select([clean_method.str.contains('ko').fillna(False).values.astype(bool),
+                                clean_method.str.contains('submission').fillna(False).values.astype(bool),
+                                clean_method.str.contains('decision').fillna(False).values.astype(bool)],
+                               ['ko', 'submission', 'decision'],
+                               'other'),
+                     index=s.index)
 
 
-def extract_details(s):
-    split_method = str(s).split('(')
-    if len(split_method) >= 2:
-        clean_method = clean_text(' '.join([i for i in split_method[1:]]))
-        return clean_method
+def extract_method_column(s):
+    before_details, details = split_method_column(s)
+    return clean_text_column(before_details).where(details.notna(), None)
+
+
+def extract_details_column(s):
+    before_details, details = split_method_column(s)
+    return clean_text_column(details.str.replace('(', ' ', regex=False)).where(details.notna(), None)
 
 
 def process_personal_data(df):
     df['birth_dt'] = pd.to_datetime(df['birth_date'], errors='coerce')
-    df['height_m'] = df['height'].apply(lambda x: convert_height_to_metric(x))
-    df['weight_m'] = df['weight'].apply(lambda x: convert_weight_to_metric(x))
+    df['height_m'] = map_unique_values(df['height'], convert_height_to_metric_column)
+    df['weight_m'] = map_unique_values(df['weight'], convert_weight_to_metric_column)
     df['name'] = df['sherdog_name'].apply(lambda x: clean_name(x))
     df = df[['fighter_id', 'nationality', 'birth_dt', 'height_m', 'weight_m', 'name']]
     return df
 
 
-def process_fight_data(df):
-    df['event_org'] = df['event_name'].apply(lambda x: get_event_org(x))
-    df['fight_dt'] = df['fight_date'].apply(lambda x: parse_event_date(x))
-    df['fight_date_str'] = df['fight_dt'].apply(lambda x: str(x))
-    df['round_end_time'] = df['fight_end_time'].apply(lambda x: extract_round_end_time(x))
-    df['fight_end_time'] = df.apply(lambda x: extract_fight_end_time(x['fight_end_round'], x['fight_end_time']), axis=1)
-    df['general_method'] = df['method'].apply(lambda x: extract_general_method(x))
-    df['method_details'] = df['method'].apply(lambda x: extract_details(x))
-    df['method'] = df['method'].apply(lambda x: extract_method(x))
+def process_fight_data(df, id_mode=id_mode_hash):
+    df['event_org'] = map_categories(df['event_name'], lambda x: x.apply(get_event_org))
+    df['fight_dt'] = pd.to_datetime(map_unique_values(df['fight_date'], parse_event_date_column))
+    df['fight_date_str'] = map_unique_values(df['fight_dt'],
+                                             lambda x: pd.to_datetime(x).dt.strftime('%Y-%m-%d %H:%M:%S').fillna('NaT'))
+    df['round_end_time'] = map_unique_values(df['fight_end_time'], extract_round_end_time_column)
+    df['fight_end_time'] = extract_fight_end_time_column(df['fight_end_round'], df['round_end_time'])
+    df['general_method'] = map_categories(df['method'], extract_general_method_column)
+    df['method_details'] = map_categories(df['method'], extract_details_column)
+    df['method'] = map_categories(df['method'], extract_method_column)
     df['fight_type'] = df['fight_type_text']
 
-    df['fight_id'] = df.apply(
-        lambda x: uuid.uuid5(uuid.NAMESPACE_DNS, str(sorted([x['fighter_id'], x['opponent_id'], x['fight_date_str']]))).hex,
-        axis=1)
-    df['fighter_matchup_id'] = df.apply(lambda x: uuid.uuid5(uuid.NAMESPACE_DNS, str([x['fighter_id'], x['opponent_id']])).hex,
-                                        axis=1)
-    df['matchup_id'] = df.apply(lambda x: uuid.uuid5(uuid.NAMESPACE_DNS, str(sorted([x['fighter_id'], x['opponent_id']]))).hex,
-                                        axis=1)
-    df['record_id'] = df.apply(lambda x: uuid.uuid5(uuid.NAMESPACE_DNS, str(
-        [x['fighter_id'], x['opponent_id'], x['fight_date_str'], x['fight_counter']])).hex, axis=1)
+    # id_mode_uuid keeps the uuid5 ids of runs processed before the hashed ids were added
+    df['fight_id'] = build_ids(df, ['fighter_id', 'opponent_id', 'fight_date_str'], sort_values=True, id_mode=id_mode)
+    df['fighter_matchup_id'] = build_ids(df, ['fighter_id', 'opponent_id'], id_mode=id_mode)
+    df['matchup_id'] = build_ids(df, ['fighter_id', 'opponent_id'], sort_values=True, id_mode=id_mode)
+    df['record_id'] = build_ids(df, ['fighter_id', 'opponent_id', 'fight_date_str', 'fight_counter'], id_mode=id_mode)
 
     res_mapping = {'win': 1.0,
                    'loss': 0.0}
-    df['result'] = df['result'].apply(lambda x: res_mapping.get(str(x).lower(), .5))
+    df['result'] = map_unique_values(df['result'], lambda x: x.apply(lambda y: res_mapping.get(str(y).lower(), .5)))
 
     df = df[['event_org', 'fight_dt', 'round_end_time', 'fight_end_time', 'fight_end_round', 'general_method',
              'method_details', 'method',
@@ -181,24 +462,111 @@ def process_fight_data(df):
     return df
 
 
-def prepare_data(run_id=None, sample=False):
+def get_id_dictionary(output_folder, name, dtype=np.int32):
+    return IdDictionary(f'{output_folder}/{id_dictionary_folder}/{name}.csv', dtype=dtype)
+
+
+def save_fighter_timeline(output_folder, df=None):
+    if df is None:
+        df = load_stage_data(output_folder, 'merged_fight_data', columns=['record_id', 'fighter_id', 'fight_dt'])
+    FighterTimeline.from_frame(df).save(f'{output_folder}/{fighter_timeline_folder}')
+
+
+def get_fighter_timeline(output_folder, df):
+    '''
+    The run's saved (memory mapped) fighter timeline pointed at the rows of df, or a timeline built from df when it
+    does not hold the same records.
+    '''
+    folder = f'{output_folder}/{fighter_timeline_folder}'
+    if os.path.exists(f'{folder}/offsets.npy'):
+        timeline = FighterTimeline.load(folder).align(df['record_id'].to_numpy())
+        if timeline is not None:
+            return timeline
+    return FighterTimeline.from_frame(df)
+
+
+def get_id_dictionaries(output_folder):
+    id_dictionaries = dict()
+    for name, dtype in interned_id_columns.values():
+        if name not in id_dictionaries:
+            id_dictionaries[name] = get_id_dictionary(output_folder, name, dtype=dtype)
+    return id_dictionaries
+
+
+def intern_fight_ids(fight_df, id_dictionaries):
+    for c, (name, dtype) in interned_id_columns.items():
+        fight_df[c] = id_dictionaries[name].encode(fight_df[c])
+    return fight_df
+
+
+def intern_ids(personal_df, fight_df, output_folder):
+    '''
+    Replaces the url and hashed id columns with integer ids from the run's persistent id dictionaries.
+    '''
+    id_dictionaries = get_id_dictionaries(output_folder)
+    fight_df = intern_fight_ids(fight_df, id_dictionaries)
+    personal_df['fighter_id'] = id_dictionaries['fighter'].encode(personal_df['fighter_id'])
+
+    for i in id_dictionaries.values():
+        i.save()
+    return personal_df, fight_df
+
+
+def prepare_data_in_chunks(output_folder, chunk_size, id_mode=id_mode_hash):
+    '''
+    Streams fight_data.csv through process_fight_data chunk_size rows at a time, appending each processed chunk to
+    the stage file, so the fight rows held in memory depend on the chunk size and not the size of the crawl. The id
+    dictionaries are not bounded: they hold one key per distinct fighter, fight and record of the crawl.
+    '''
+    personal_dtypes = {c: 'category' for c in raw_personal_categorical_columns}
+    fight_dtypes = {c: 'category' for c in raw_fight_categorical_columns}
+    id_dictionaries = get_id_dictionaries(output_folder)
+
+    writer = StageWriter(output_folder, 'processed_fight_data')
+    for fight_df in pd.read_csv(f'{output_folder}/fight_data.csv', sep='|', dtype=fight_dtypes, chunksize=chunk_size):
+        fight_df = process_fight_data(fight_df, id_mode=id_mode)
+        fight_df = intern_fight_ids(fight_df, id_dictionaries)
+        writer.write(fight_df)
+        print(f'prepare_data processed {writer.row_count} fight rows')
+    writer.close()
+
+    personal_df = pd.read_csv(f'{output_folder}/personal_data.csv', sep='|', dtype=personal_dtypes)
+    personal_df = process_personal_data(personal_df)
+    personal_df['fighter_id'] = id_dictionaries['fighter'].encode(personal_df['fighter_id'])
+    save_stage_data(personal_df, output_folder, 'processed_fighter_data')
+
+    for i in id_dictionaries.values():
+        i.save()
+
+
+def prepare_data(run_id=None, sample=False, id_mode=id_mode_hash, chunk_size=None):
+    '''
+    :param chunk_size: if set, fight rows are processed and written chunk_size rows at a time
+    '''
     print('running prepare_data')
     output_folder = f'{base_output_folder}/{run_id}'
+    if chunk_size and not sample:
+        prepare_data_in_chunks(output_folder, chunk_size, id_mode=id_mode)
+        return
+
+    personal_dtypes = {c: 'category' for c in raw_personal_categorical_columns}
+    fight_dtypes = {c: 'category' for c in raw_fight_categorical_columns}
     if sample:
-        personal_df = pd.read_csv(f'{output_folder}/personal_data.csv', sep='|', nrows=1000)
-        fight_df = pd.read_csv(f'{output_folder}/fight_data.csv', sep='|', nrows=1000)
+        personal_df = pd.read_csv(f'{output_folder}/personal_data.csv', sep='|', nrows=1000, dtype=personal_dtypes)
+        fight_df = pd.read_csv(f'{output_folder}/fight_data.csv', sep='|', nrows=1000, dtype=fight_dtypes)
     else:
-        personal_df = pd.read_csv(f'{output_folder}/personal_data.csv', sep='|')
-        fight_df = pd.read_csv(f'{output_folder}/fight_data.csv', sep='|')
+        personal_df = pd.read_csv(f'{output_folder}/personal_data.csv', sep='|', dtype=personal_dtypes)
+        fight_df = pd.read_csv(f'{output_folder}/fight_data.csv', sep='|', dtype=fight_dtypes)
     print('prepare_data loaded files: {0} {1}'.format(personal_df.shape, fight_df.shape))
 
     personal_df = process_personal_data(personal_df)
-    fight_df = process_fight_data(fight_df)
+    fight_df = process_fight_data(fight_df, id_mode=id_mode)
+    personal_df, fight_df = intern_ids(personal_df, fight_df, output_folder)
     # fighter_ids = set(personal_df['fighter_id'])
     # fight_df = fight_df[(fight_df['fighter_id'].isin(fighter_ids)) & (fight_df['opponent_id'].isin(fighter_ids))]
 
-    personal_df.to_csv(f'{output_folder}/processed_fighter_data.csv', sep='|', index=False)
-    fight_df.to_csv(f'{output_folder}/processed_fight_data.csv', sep='|', index=False)
+    save_stage_data(personal_df, output_folder, 'processed_fighter_data')
+    save_stage_data(fight_df, output_folder, 'processed_fight_data')
     print(fight_df.columns.tolist())
     print('finished preparing data: {0} {1}'.format(personal_df.shape, fight_df.shape))
 
@@ -206,28 +574,45 @@ def prepare_data(run_id=None, sample=False):
 ######################################################################################################################
 # Rating calculation
 
-def get_most_recent_record_before_date(df, date, fighter_id):
-    sub_df = df[(df['fight_dt'] < date) & (df['fighter_id'] == fighter_id)]
-    if not sub_df.empty:
-        return sub_df.iloc[-1]
-    return sub_df
+def get_rating_data_path(rating_id, output_folder):
+    return f'{output_folder}/temp_ratings/{rating_id}_state.pkl'
+
 
+def get_rating_records_key(record_ids):
+    '''
+    Hash of the records a rating runs over, in processing order, so a checkpoint is only resumed on the same records.
+    '''
+    return hashlib.md5(np.ascontiguousarray(record_ids, dtype=np.int64).tobytes()).hexdigest()
 
-def save_rating_data(df, filtered_df, filtered_dicts, iteration, rating_id, output_folder):
+
+def save_rating_data(rating_arrays, iteration, records_key, rating_id, output_folder):
     start_time = time.time()
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
     if not os.path.exists(f'{output_folder}/temp_ratings'):
-        os.mkdir(f'{output_folder}/temp_ratings')
-    df.to_csv(f'{output_folder}/temp_ratings/{rating_id}_df.csv', sep='|', index=False)
-    filtered_df.to_csv(f'{output_folder}/temp_ratings/{rating_id}_filtered_df.csv', sep='|', index=False)
-    with open(f'{output_folder}/temp_ratings/{rating_id}_filtered_dicts.pkl', 'wb') as f:
-        pickle.dump(filtered_dicts, f)
-    with open(f'{output_folder}/temp_ratings/{rating_id}_iteration.pkl', 'wb') as f:
-        pickle.dump(iteration, f)
+        os.makedirs(f'{output_folder}/temp_ratings')
+    with open(get_rating_data_path(rating_id, output_folder), 'wb') as f:
+        pickle.dump({'records_key': records_key, 'rating_arrays': rating_arrays, 'iteration': iteration}, f)
     print(f'saving data at iteration {iteration}, took: {time.time() - start_time} seconds')
 
 
+def load_rating_data(rating_id, output_folder, records_key):
+    '''
+    The checkpointed (rating arrays, iteration), or (None, 0) when there is none or it was saved for other records.
+    '''
+    path = get_rating_data_path(rating_id, output_folder)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if isinstance(saved, dict) and saved['records_key'] == records_key:
+            return saved['rating_arrays'], saved['iteration']
+        print(f'discarding rating checkpoint {path}, it was saved for other fight records')
+    return None, 0
+
+
+def remove_rating_data(rating_id, output_folder):
+    path = get_rating_data_path(rating_id, output_folder)
+    if os.path.exists(path):
+        os.remove(path)
+
 
 def calculate_rating(df, filtered_df, col_name, rating_id, rating_type, use_saved_data, output_folder,
                      save_frequency):
@@ -240,92 +625,72 @@ def calculate_rating(df, filtered_df, col_name, rating_id, rating_type, use_save
     post_fight_fighter_col_name = f'fighter_{base_col_name}_fighter_post_fight'
     pre_fight_opponent_col_name = f'opponent_{base_col_name}_pre_fight'
     post_fight_opponent_col_name = f'opponent_{base_col_name}_post_fight'
-    # pre_fight_rating_diff_col_name = f'{base_col_name}_pre_fight_rating_diff'
-
-    if use_saved_data and os.path.exists(f'{output_folder}/temp_ratings/{rating_id}_df.csv') and \
-            os.path.exists(f'{output_folder}/temp_ratings/{rating_id}_filtered_df.csv') and \
-            os.path.exists(f'{output_folder}/temp_ratings/{rating_id}_filtered_dicts.pkl') and \
-            os.path.exists(f'{output_folder}/temp_ratings/{rating_id}_iteration.pkl'):
-        df = pd.read_csv(f'{output_folder}/temp_ratings/{rating_id}_df.csv', sep='|')
-        filtered_df = pd.read_csv(f'{output_folder}/temp_ratings/{rating_id}_filtered_df.csv', sep='|')
-        with open(f'{output_folder}/temp_ratings/{rating_id}_filtered_dicts.pkl', 'rb') as f:
-            filtered_dicts = pickle.load(f)
-        with open(f'{output_folder}/temp_ratings/{rating_id}_iteration.pkl', 'rb') as f:
-            iteration = pickle.load(f)
-
-        print(f'resuming rating calculation at iteration {iteration}')
-
-    else:
-        filtered_df[pre_fight_fighter_col_name] = None
-        filtered_df[post_fight_fighter_col_name] = None
-        filtered_df[pre_fight_opponent_col_name] = None
-        filtered_df[post_fight_opponent_col_name] = None
-        filtered_df = filtered_df.sort_values('fight_dt')
-        filtered_dicts = filtered_df.to_dict(orient='records')
-        iteration = 0
-
-    for r in tqdm.tqdm(filtered_dicts[iteration:]):
-        outcome = r['result']
-        previous_fighter_record = get_most_recent_record_before_date(filtered_df, r['fight_dt'], r['fighter_id'])
-        previous_opponent_record = get_most_recent_record_before_date(filtered_df, r['fight_dt'], r['opponent_id'])
+    rating_col_names = [pre_fight_fighter_col_name, post_fight_fighter_col_name, pre_fight_opponent_col_name,
+                        post_fight_opponent_col_name]
+
+    filtered_df = filtered_df.sort_values('fight_dt')
+    row_count = filtered_df.shape[0]
+
+    # frame row of the fighter's and the opponent's most recent earlier record, looked up once on the timeline
+    timeline = FighterTimeline.from_frame(filtered_df)
+    previous_fighter_rows = timeline.get_last_before(filtered_df['fighter_id'], filtered_df['fight_dt'])
+    previous_opponent_rows = timeline.get_last_before(filtered_df['opponent_id'], filtered_df['fight_dt'])
+    outcomes = filtered_df['result'].to_numpy()
+    records_key = get_rating_records_key(filtered_df['record_id'].to_numpy())
+
+    rating_arrays, iteration = None, 0
+    if use_saved_data:
+        rating_arrays, iteration = load_rating_data(rating_id, output_folder, records_key)
+        if rating_arrays is not None:
+            print(f'resuming rating calculation at iteration {iteration}')
+    if rating_arrays is None:
+        rating_arrays, iteration = np.full((4, row_count), np.nan), 0
+    pre_fighter_ratings, post_fighter_ratings, pre_opponent_ratings, post_opponent_ratings = rating_arrays
+
+    for i in tqdm.tqdm(range(iteration, row_count)):
+        outcome = outcomes[i]
 
         pre_fight_fighter_rating = None
         pre_fight_opponent_rating = None
 
-        if not previous_fighter_record.empty:
-            pre_fight_fighter_rating = previous_fighter_record[post_fight_fighter_col_name]
-        if not previous_opponent_record.empty:
-            pre_fight_opponent_rating = previous_opponent_record[post_fight_fighter_col_name]
+        if previous_fighter_rows[i] >= 0:
+            pre_fight_fighter_rating = post_fighter_ratings[previous_fighter_rows[i]]
+        if previous_opponent_rows[i] >= 0:
+            pre_fight_opponent_rating = post_fighter_ratings[previous_opponent_rows[i]]
         if not pre_fight_fighter_rating:
             pre_fight_fighter_rating = starting_rating
         if not pre_fight_opponent_rating:
             pre_fight_opponent_rating = starting_rating
 
-        post_fight_fighter_rating = get_new_rating(pre_fight_fighter_rating, pre_fight_opponent_rating, outcome,
-                                                   rating_type=rating_type)
-        post_fight_opponent_rating = get_new_rating(pre_fight_opponent_rating, pre_fight_fighter_rating,
-                                                    1.0 if outcome == 0.0 else 0.0, rating_type=rating_type)
-
-        filtered_df.loc[(filtered_df['fight_id'] == r['fight_id']) & (
-                filtered_df['fighter_id'] == r['fighter_id']), pre_fight_fighter_col_name] = pre_fight_fighter_rating
-        filtered_df.loc[(filtered_df['fight_id'] == r['fight_id']) & (
-                filtered_df['fighter_id'] == r['fighter_id']), pre_fight_opponent_col_name] = pre_fight_opponent_rating
-        filtered_df.loc[(filtered_df['fight_id'] == r['fight_id']) & (
-                filtered_df['fighter_id'] == r['fighter_id']), post_fight_fighter_col_name] = post_fight_fighter_rating
-        filtered_df.loc[(filtered_df['fight_id'] == r['fight_id']) & (
-                filtered_df['fighter_id'] == r[
-            'fighter_id']), post_fight_opponent_col_name] = post_fight_opponent_rating
+        pre_fighter_ratings[i] = pre_fight_fighter_rating
+        pre_opponent_ratings[i] = pre_fight_opponent_rating
+        post_fighter_ratings[i] = get_new_rating(pre_fight_fighter_rating, pre_fight_opponent_rating, outcome,
+                                                 rating_type=rating_type)
+        post_opponent_ratings[i] = get_new_rating(pre_fight_opponent_rating, pre_fight_fighter_rating,
+                                                  1.0 if outcome == 0.0 else 0.0, rating_type=rating_type)
 
         iteration += 1
         if iteration % save_frequency == 0:
-            save_rating_data(df, filtered_df, filtered_dicts, iteration, rating_id, output_folder)
+            save_rating_data(rating_arrays, iteration, records_key, rating_id, output_folder)
 
-    save_rating_data(df, filtered_df, filtered_dicts, iteration, rating_id, output_folder)
+    # the checkpoint only serves to resume an interrupted run, a finished rating is never resumed
+    remove_rating_data(rating_id, output_folder)
+
+    for c, v in zip(rating_col_names, rating_arrays):
+        filtered_df[c] = v
+    # repeated (fight, fighter) records all carry the ratings of the last one processed
+    filtered_df[rating_col_names] = filtered_df.groupby(['fight_id', 'fighter_id'])[rating_col_names].transform('last')
 
     filtered_df = filtered_df[
         ['fight_id', 'fighter_id', 'fight_dt', pre_fight_fighter_col_name, post_fight_fighter_col_name]]
     df = df.merge(filtered_df, how='left', on=['fight_id', 'fighter_id', 'fight_dt'])
-    df = df[['record_id', 'fight_id', 'fighter_id', 'fight_dt', pre_fight_fighter_col_name, post_fight_fighter_col_name]]
-
-    fighter_ids = set(df['fighter_id'])
-    fighter_id_dict = dict()
-    for fighter_id in tqdm.tqdm(fighter_ids):
-        fighter_id_dict[fighter_id] = df[df['fighter_id'] == fighter_id]
 
-    out_dfs = []
-    for fighter_id in tqdm.tqdm(fighter_ids):
-        temp_df = fighter_id_dict[fighter_id].copy()
-        temp_df = temp_df.sort_values('fight_dt')
+    # fights outside the subset carry the fighter's last rating forward
+    timeline = FighterTimeline.from_frame(df)
+    pre_fight_ratings = timeline.forward_fill(timeline.take(df[pre_fight_fighter_col_name].astype(float)))
+    df[pre_fight_fighter_col_name] = timeline.to_frame_order(pre_fight_ratings)
+    df[pre_fight_fighter_col_name] = df[pre_fight_fighter_col_name].fillna(starting_rating)
 
-        temp_df[pre_fight_fighter_col_name] = temp_df[pre_fight_fighter_col_name].fillna(method='ffill')
-        temp_df[post_fight_fighter_col_name] = temp_df[post_fight_fighter_col_name].fillna(method='ffill')
-        temp_df[pre_fight_fighter_col_name] = temp_df[pre_fight_fighter_col_name].fillna(starting_rating)
-        temp_df[post_fight_fighter_col_name] = temp_df[post_fight_fighter_col_name].fillna(starting_rating)
-
-
-        out_dfs.append(temp_df)
-
-    df = pd.concat(out_dfs)
     df = df[['record_id', pre_fight_fighter_col_name]]
     return df
 
@@ -335,9 +700,9 @@ def calculate_all_ratings(run_id, min_perc=.04, methods=(0,), use_saved_data=Fal
     output_folder = f'{base_output_folder}/{run_id}'
 
     rating_dfs = []
-    df = pd.read_csv(f'{output_folder}/processed_fight_data.csv', sep='|')
-    df = df[['record_id', 'fight_id', 'fighter_id', 'opponent_id', 'result', 'fight_dt', 'general_method', 'event_org',
-             'method_details']]
+    df = load_stage_data(output_folder, 'processed_fight_data',
+                         columns=['record_id', 'fight_id', 'fighter_id', 'opponent_id', 'result', 'fight_dt',
+                                  'general_method', 'event_org', 'method_details'])
 
     df = df.sort_values('fight_dt')
 
@@ -369,241 +734,540 @@ def calculate_all_ratings(run_id, min_perc=.04, methods=(0,), use_saved_data=Fal
         out_df = out_df.merge(i)
 
     print(out_df.shape)
-    out_df.to_csv(f'{output_folder}/fighter_ratings.csv', sep='|', index=False)
+    save_stage_data(out_df, output_folder, 'fighter_ratings')
 
 
 #######################################################################################################################
 # Feature extraction
 
 
-def get_age(birth_date, current_date):
-    birth_date_split = parse_list_of_ints_from_str(birth_date)
-    current_date_split = parse_list_of_ints_from_str(current_date)
+def get_age_column(birth_dt, current_dt):
+    '''
+    Age in days between two date columns, missing where either date is missing. Takes datetimes as loaded from the
+    typed stages as well as date strings.
+    '''
+    return (pd.to_datetime(current_dt, errors='coerce') - pd.to_datetime(birth_dt, errors='coerce')).dt.days
+
 
-    if len(birth_date_split) == 3 and len(current_date_split) == 3:
-        birth_dt = datetime.datetime(birth_date_split[0], birth_date_split[1], birth_date_split[2])
-        current_dt = datetime.datetime(current_date_split[0], current_date_split[1], current_date_split[2])
-        return (current_dt - birth_dt).days
+def get_category_code_map(output_folder, name):
+    '''
+    Persisted value to int code map for a categorical feature, shared by the training build and serving.
+    '''
+    return get_id_dictionary(output_folder, f'{category_code_prefix}{name}')
 
 
-def merge_fighter_data(run_id):
+def get_category_codes(run_id, name, values):
+    '''
+    Codes of a categorical feature from the run's saved code map, for serving. Unseen values are coded -1.
+    '''
+    code_map = get_category_code_map(f'{base_output_folder}/{run_id}', name)
+    return code_map.encode(pd.Series(values).astype(object).fillna(nan_cat), add_keys=False)
+
+
+def get_fighter_merge_tables(fighter_df):
+    fighter_side_df = fighter_df.copy()
+    fighter_side_df.columns = [f'fighter_{i}' if 'fighter' not in i else i for i in fighter_side_df.columns]
+
+    opponent_side_df = fighter_df.copy()
+    opponent_side_df.columns = [f'opponent_{i}' if 'fighter' not in i else i for i in opponent_side_df.columns]
+    opponent_side_df['opponent_id'] = opponent_side_df['fighter_id']
+    opponent_side_df = opponent_side_df.drop('fighter_id', axis=1)
+    return fighter_side_df, opponent_side_df
+
+
+def join_fighter_tables(df, fighter_df, opponent_df):
+    '''
+    Inner join of the fight rows to both sides' fighter data that keeps the fight row order (an inner merge groups
+    the rows by key), so the chunked and unchunked merges write their rows in the same order.
+    '''
+    df = df[df['fighter_id'].isin(fighter_df['fighter_id']) & df['opponent_id'].isin(opponent_df['opponent_id'])]
+    df = df.merge(fighter_df, on=['fighter_id'], how='left')
+    return df.merge(opponent_df, on=['opponent_id'], how='left')
+
+
+def merge_fighter_data(run_id, chunk_size=None):
+    '''
+    :param chunk_size: if set, fight rows are joined to the fighter table and written chunk_size rows at a time. The
+    fighter table and the id/date columns the fighter timeline and mirror rows are built from (merge_index_columns)
+    are still held for the whole crawl.
+    '''
     print('merge_fighter_data')
     output_folder = f'{base_output_folder}/{run_id}'
 
-    df = pd.read_csv(f'{output_folder}/processed_fight_data.csv', sep='|')
+    fighter_df, opponent_df = get_fighter_merge_tables(load_stage_data(output_folder, 'processed_fighter_data'))
+
+    if chunk_size:
+        writer = StageWriter(output_folder, 'merged_fight_data')
+        index_dfs = []
+        for df in iter_stage_data_chunks(output_folder, 'processed_fight_data', chunk_size):
+            df = join_fighter_tables(df, fighter_df, opponent_df)
+            writer.write(df)
+            index_dfs.append(df[merge_index_columns])
+        writer.close()
+        print(f'merge_fighter_data wrote {writer.row_count} rows')
+        index_df = pd.concat(index_dfs, ignore_index=True)
+        save_fighter_timeline(output_folder, index_df)
+        save_mirror_rows(output_folder, index_df)
+        return
+
+    df = load_stage_data(output_folder, 'processed_fight_data')
     print(df.shape)
-    fighter_df = pd.read_csv(f'{output_folder}/processed_fighter_data.csv', sep='|')
-    fighter_df.columns = [f'fighter_{i}' if 'fighter' not in i else i for i in fighter_df.columns]
-    df = df.merge(fighter_df, on=['fighter_id'])
-
-    fighter_df = pd.read_csv(f'{output_folder}/processed_fighter_data.csv', sep='|')
-    fighter_df.columns = [f'opponent_{i}' if 'fighter' not in i else i for i in fighter_df.columns]
-    fighter_df['opponent_id'] = fighter_df['fighter_id']
-    fighter_df = fighter_df.drop('fighter_id', axis=1)
-    df = df.merge(fighter_df, on=['opponent_id'])
-    df.to_csv(f'{output_folder}/merged_fight_data.csv', sep='|', index=False)
+    df = join_fighter_tables(df, fighter_df, opponent_df)
+    save_stage_data(df, output_folder, 'merged_fight_data')
+    save_fighter_timeline(output_folder, df)
+    save_mirror_rows(output_folder, df)
     print(df.shape)
 
 
+def get_decoded_merge_outputs(output_folder):
+    '''
+    prepare_data/merge_fighter_data outputs with the interned ids decoded to their keys, the fighter timeline as each
+    record's position in its fighter's history and the mirror rows as the mirrored record, all ordered by key, so
+    runs that interned the ids in a different order compare equal.
+    '''
+    id_dictionaries = get_id_dictionaries(output_folder)
+    outputs = dict()
+    for name in ['processed_fighter_data', 'processed_fight_data', 'merged_fight_data']:
+        df = load_stage_data(output_folder, name)
+        for c, (dictionary_name, dtype) in interned_id_columns.items():
+            if c in df.columns:
+                df[c] = id_dictionaries[dictionary_name].decode(df[c])
+        for c in df.columns:
+            if str(df[c].dtype) == 'category':
+                df[c] = df[c].astype(object)
+        key = 'record_id' if 'record_id' in df.columns else 'fighter_id'
+        outputs[name] = df.sort_values(key).reset_index(drop=True)
+
+    df = load_stage_data(output_folder, 'merged_fight_data', columns=merge_index_columns)
+    timeline = FighterTimeline.load(f'{output_folder}/{fighter_timeline_folder}')
+    mirror_rows = np.load(f'{output_folder}/{mirror_rows_file_name}')
+    record_keys = id_dictionaries['record'].decode(df['record_id'])
+    index_df = pd.DataFrame({'record_id': id_dictionaries['record'].decode(timeline.record_ids),
+                             'timeline_position': timeline.get_positions()})
+    index_df = index_df.merge(pd.DataFrame({'record_id': record_keys,
+                                            'mirror_record_id': np.where(mirror_rows >= 0,
+                                                                         record_keys[np.maximum(mirror_rows, 0)],
+                                                                         None)}))
+    outputs['merge_index'] = index_df.sort_values('record_id').reset_index(drop=True)
+    return outputs
+
+
+def check_chunked_merge(run_id, chunk_size, id_mode=id_mode_hash):
+    '''
+    Runs prepare_data and merge_fighter_data on the run's scraped files once unchunked and once in chunk_size
+    chunks, each in a scratch copy of the run folder, and raises an AssertionError if any output differs.
+    '''
+    output_folder = f'{base_output_folder}/{run_id}'
+    outputs = dict()
+    for mode, mode_chunk_size in [('unchunked', None), ('chunked', chunk_size)]:
+        check_run_id = f'{run_id}/{chunk_check_folder}/{mode}'
+        check_folder = f'{base_output_folder}/{check_run_id}'
+        shutil.rmtree(check_folder, ignore_errors=True)
+        os.makedirs(check_folder)
+        for file_name in ['fight_data.csv', 'personal_data.csv']:
+            shutil.copy(f'{output_folder}/{file_name}', check_folder)
+        prepare_data(check_run_id, id_mode=id_mode, chunk_size=mode_chunk_size)
+        merge_fighter_data(check_run_id, chunk_size=mode_chunk_size)
+        outputs[mode] = get_decoded_merge_outputs(check_folder)
+
+    for name, df in outputs['unchunked'].items():
+        pd.testing.assert_frame_equal(df, outputs['chunked'][name], obj=name)
+    shutil.rmtree(f'{output_folder}/{chunk_check_folder}')
+    print(f'chunked and unchunked merge outputs match, chunk size {chunk_size}')
+
+
 def build_personal_features(run_id):
     print('build_personal_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
+    df = load_stage_data(output_folder, 'merged_fight_data',
+                         columns=['record_id', 'fighter_nationality', 'fighter_birth_dt', 'fighter_height_m',
+                                  'fight_dt'])
 
-    le = LabelEncoder()
-    df['fighter_nationality_enc'] = le.fit_transform(df['fighter_nationality'].fillna(nan_cat))
-    df['fighter_age'] = df.apply(lambda x: get_age(x['fighter_birth_dt'], x['fight_dt']), axis=1)
-    df['fighter_height'] = df.apply(lambda x: get_age(x['fighter_birth_dt'], x['fight_dt']), axis=1)
+    nationality_codes = get_category_code_map(output_folder, 'nationality')
+    df['fighter_nationality_enc'] = nationality_codes.encode(df['fighter_nationality'].astype(object).fillna(nan_cat))
+    nationality_codes.save()
+    df['fighter_age'] = get_age_column(df['fighter_birth_dt'], df['fight_dt'])
+    df['fighter_height'] = df['fighter_height_m']
 
     df = df[['record_id', 'fighter_nationality_enc', 'fighter_age', 'fighter_height']]
     df = df.drop_duplicates()
-    df.to_csv(f'{output_folder}/personal_features.csv', sep='|', index=False)
+    save_stage_data(df, output_folder, 'personal_features')
 
 
 def build_date_features(run_id):
     print('build_date_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
+    df = load_stage_data(output_folder, 'merged_fight_data', columns=['record_id', 'fight_dt'])
     df['fight_dt2'] = pd.to_datetime(df['fight_dt'], errors='coerce')
     df['fight_day_of_week'] = df['fight_dt2'].dt.dayofweek
     df['fight_year'] = df['fight_dt2'].dt.year
     df['fight_month'] = df['fight_dt2'].dt.month
     df = df[['record_id', 'fight_day_of_week', 'fight_year', 'fight_month']]
-    df.to_csv(f'{output_folder}/date_features.csv', sep='|', index=False)
+    save_stage_data(df, output_folder, 'date_features')
 
 
 def build_fight_timing_features(run_id):
     print('build_fight_timing_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
-    df['fight_dt2'] = pd.to_datetime(df['fight_dt'], errors='coerce')
-    df = df.sort_values('fight_dt2')
-    df['fighter_days_since_last_fight'] = df.groupby('fighter_id')['fight_dt2'].diff().dt.days
+    df = load_stage_data(output_folder, 'merged_fight_data', columns=['record_id', 'fighter_id', 'fight_dt'])
+    timeline = get_fighter_timeline(output_folder, df)
+    days_since_last_fight = timeline.diff(timeline.take(pd.to_datetime(df['fight_dt'], errors='coerce')))
+    df['fighter_days_since_last_fight'] = pd.Series(timeline.to_frame_order(days_since_last_fight)).dt.days.values
     df = df[['record_id', 'fighter_days_since_last_fight']]
-    df.to_csv(f'{output_folder}/fight_timing_features.csv', sep='|', index=False)
+    save_stage_data(df, output_folder, 'fight_timing_features')
 
 
 def build_rematch_features(run_id):
     print('build_rematch_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
+    df = load_stage_data(output_folder, 'merged_fight_data',
+                         columns=['record_id', 'fighter_matchup_id', 'fight_dt', 'result'])
     df = df.sort_values('fight_dt')
     df['fight_dt2'] = pd.to_datetime(df['fight_dt'], errors='coerce')
 
-    all_matchups = dict(df['fighter_matchup_id'].value_counts())
-    print(len(all_matchups))
-    for m, c in tqdm.tqdm(all_matchups.items()):
-        if c == 1:
-            continue
-
-        df.loc[df['fighter_matchup_id'] == m, 'fighter_days_since_last_fight_in_matchup'] = df.loc[df['fighter_matchup_id'] == m].groupby(['fighter_matchup_id'])['fight_dt2'].diff().dt.days
-        df.loc[df['fighter_matchup_id'] == m, 'fighter_result_in_last_matchup'] = df.loc[df['fighter_matchup_id'] == m].groupby(['fighter_matchup_id'])['result'].diff()
+    # one grouped pass over the date sorted frame, a fighter's first fight in a matchup has no previous meeting
+    matchup_groups = df.groupby('fighter_matchup_id', sort=False)
+    df['fighter_days_since_last_fight_in_matchup'] = matchup_groups['fight_dt2'].diff().dt.days
+    df['fighter_result_in_last_matchup'] = matchup_groups['result'].diff()
 
     df = df[['record_id', 'fighter_days_since_last_fight_in_matchup', 'fighter_result_in_last_matchup']]
-    df.to_csv(f'{output_folder}/rematch_features.csv', sep='|', index=False)
+    save_stage_data(df, output_folder, 'rematch_features')
+
+
+def get_career_stat_values(df):
+    stats_df = pd.DataFrame(index=df.index)
+    stats_df['fights'] = 1
+    stats_df['wins'] = (df['result'] == 1.0).astype(int)
+    stats_df['losses'] = (df['result'] == 0.0).astype(int)
+    for m in ['ko', 'submission', 'decision']:
+        stats_df[m] = (df['general_method'] == m).astype(int)
+    stats_df['cage_time'] = df['fight_end_time']
+    return stats_df
+
+
+def get_career_features(totals_df, prefix='fighter_career_'):
+    fights = totals_df['fights']
+    df = pd.DataFrame(index=totals_df.index)
+    df[f'{prefix}fights'] = fights
+    df[f'{prefix}wins'] = totals_df['wins']
+    df[f'{prefix}losses'] = totals_df['losses']
+    for c in ['wins', 'ko', 'submission', 'decision']:
+        rate_name = 'win' if c == 'wins' else c
+        df[f'{prefix}{rate_name}_rate'] = (totals_df[c] / fights.where(fights > 0)).fillna(0)
+    df[f'{prefix}cage_time'] = totals_df['cage_time']
+    return df
 
 
-def merge_initial_features(run_id):
+def build_career_features(run_id):
+    '''
+    Career to date totals before every fight, from prefix sums over the fighter timeline. The prefix sums are saved
+    so get_career_features_as_of can serve the same features for any fighter as of a later date.
+    '''
+    print('build_career_features')
+    output_folder = f'{base_output_folder}/{run_id}'
+    df = load_stage_data(output_folder, 'merged_fight_data',
+                         columns=['record_id', 'fighter_id', 'fight_dt', 'result', 'general_method', 'fight_end_time'])
+    timeline = get_fighter_timeline(output_folder, df)
+    career_stats = CareerStats.from_frame(get_career_stat_values(df), timeline, career_stat_names)
+    career_stats.save(f'{output_folder}/{career_stats_folder}')
+
+    features_df = get_career_features(career_stats.get_before_each_fight())
+    features_df.insert(0, 'record_id', df['record_id'].values)
+    save_stage_data(features_df, output_folder, 'career_features')
+
+
+def get_career_features_as_of(run_id, fighter_ids, date):
+    '''
+    Career features of each fighter counting every fight strictly before date, for fights not in the data yet.
+    '''
+    career_stats = CareerStats.load(f'{base_output_folder}/{run_id}/{career_stats_folder}')
+    features_df = get_career_features(career_stats.get_as_of(fighter_ids, date))
+    features_df.insert(0, 'fighter_id', np.asarray(fighter_ids))
+    return features_df
+
+
+def get_form_stat_values(df):
+    stats_df = pd.DataFrame(index=df.index)
+    stats_df['result'] = df['result']
+    for m in ['ko', 'submission', 'decision']:
+        stats_df[m] = (df['general_method'] == m).astype(float)
+    stats_df['fight_end_time'] = df['fight_end_time']
+    return stats_df[form_stat_names].to_numpy(dtype=np.float64)
+
+
+def get_form_features(form, means, fight_counts, prefix='fighter_form_'):
+    features = dict()
+    for h_index, h in enumerate(form.half_lives):
+        for s_index, s in enumerate(form.stat_names):
+            features[f'{prefix}{s}_{int(h)}d'] = means[:, h_index, s_index]
+        features[f'{prefix}fights_{int(h)}d'] = fight_counts[:, h_index]
+    return pd.DataFrame(features).fillna(0)
+
+
+def build_form_features(run_id):
+    '''
+    Exponentially decayed form before every fight for each half life in form_half_lives. The state after the last
+    fight is saved so later fights can be added with update_fighter_form and current form read with
+    get_form_features_as_of, neither touching the history.
+    '''
+    print('build_form_features')
+    output_folder = f'{base_output_folder}/{run_id}'
+    df = load_stage_data(output_folder, 'merged_fight_data',
+                         columns=['record_id', 'fighter_id', 'fight_dt', 'result', 'general_method', 'fight_end_time'])
+    timeline = get_fighter_timeline(output_folder, df)
+    form = FighterForm(form_half_lives, form_stat_names)
+    means, fight_counts = form.update_from_timeline(timeline, get_form_stat_values(df))
+    form.save(f'{output_folder}/{fighter_form_file_name}')
+
+    features_df = get_form_features(form, means, fight_counts)
+    features_df = features_df.iloc[np.argsort(timeline.order)].reset_index(drop=True)
+    features_df.insert(0, 'record_id', df['record_id'].values)
+    save_stage_data(features_df, output_folder, 'form_features')
+
+
+def update_fighter_form(run_id, fight_df):
+    '''
+    Adds new fights (interned fighter_id, fight_dt, result, general_method, fight_end_time) to the saved form state,
+    in date order.
+    '''
+    path = f'{base_output_folder}/{run_id}/{fighter_form_file_name}'
+    form = FighterForm.load(path)
+    fight_df = fight_df.sort_values('fight_dt')
+    values = get_form_stat_values(fight_df)
+    days = get_days(fight_df['fight_dt'])
+    for fighter_id, day, v in zip(fight_df['fighter_id'].to_numpy(), days, values):
+        form.update(np.array([fighter_id]), np.array([day]), v[None, :])
+    form.save(path)
+
+
+def get_form_features_as_of(run_id, fighter_ids, date):
+    form = FighterForm.load(f'{base_output_folder}/{run_id}/{fighter_form_file_name}')
+    fighter_ids = np.asarray(fighter_ids)
+    means, fight_counts = form.read(fighter_ids, get_days(pd.Series([date] * len(fighter_ids))))
+    features_df = get_form_features(form, means, fight_counts)
+    features_df.insert(0, 'fighter_id', fighter_ids)
+    return features_df
+
+
+def get_record_rows(feature_record_ids, record_ids):
+    '''
+    Row of each record in a feature table, -1 where the table has no row for it. Record ids are the dense interned
+    ints, so this is an array lookup rather than a hash join. Repeated records in the table resolve to the last row.
+    '''
+    feature_record_ids = np.asarray(feature_record_ids)
+    record_ids = np.asarray(record_ids)
+    size = max(feature_record_ids.max(initial=-1), record_ids.max(initial=-1)) + 1
+    feature_rows = np.full(size, -1, dtype=np.int64)
+    feature_rows[feature_record_ids] = np.arange(len(feature_record_ids))
+    return feature_rows[record_ids]
+
+
+def align_to_records(feature_df, record_ids, name='', validate=False):
+    '''
+    Feature columns of feature_df in the row order of record_ids, missing where the table has no row for a record.
+    With validate set, raises if the table has repeated or missing records, or if its aligned rows do not carry the
+    record ids they were aligned to.
+    '''
+    rows = get_record_rows(feature_df['record_id'].values, record_ids)
+    if validate:
+        repeated_count = feature_df.shape[0] - feature_df['record_id'].nunique()
+        missing_count = int((rows == -1).sum())
+        if repeated_count or missing_count:
+            raise ValueError(f'{name} is not aligned to the fight records: {repeated_count} repeated records, '
+                             f'{missing_count} records missing')
+        if not np.array_equal(feature_df['record_id'].values[rows], record_ids):
+            raise ValueError(f'{name} rows are not in fight record order after aligning')
+
+    aligned_df = feature_df.drop('record_id', axis=1).iloc[np.maximum(rows, 0)].reset_index(drop=True)
+    if (rows == -1).any():
+        aligned_df.loc[rows == -1, :] = np.nan
+    return aligned_df
+
+
+def merge_initial_features(run_id, validate=False):
+    '''
+    Lines up every initial feature table with merged_fight_data by record id and concatenates the columns, with no
+    merges. With validate set, each table must hold exactly one row per fight record.
+    '''
     print('merge_initial_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
-    personal_features = pd.read_csv(f'{output_folder}/personal_features.csv', sep='|')
-    date_features = pd.read_csv(f'{output_folder}/date_features.csv', sep='|')
-    fight_timing_features = pd.read_csv(f'{output_folder}/fight_timing_features.csv', sep='|')
-    rematch_features = pd.read_csv(f'{output_folder}/rematch_features.csv', sep='|')
-    rating_features = pd.read_csv(f'{output_folder}/fighter_ratings.csv', sep='|')
-
-    df_out = df[['record_id', 'fighter_id', 'opponent_id']]
-    print(df_out.shape)
-    df_out = df_out.merge(personal_features, on = 'record_id', how = 'left')
-    print(df_out.shape)
-    df_out = df_out.merge(date_features, on = 'record_id', how = 'left')
-    print(df_out.shape)
-    df_out = df_out.merge(fight_timing_features, on = 'record_id', how = 'left')
-    print(df_out.shape)
-    df_out = df_out.merge(rematch_features, on = 'record_id', how = 'left')
-    print(df_out.shape)
-    df_out = df_out.merge(rating_features, on = 'record_id', how = 'left')
+    df = load_stage_data(output_folder, 'merged_fight_data').reset_index(drop=True)
+    record_ids = df['record_id'].values
+
+    feature_dfs = [df[['record_id', 'fighter_id', 'opponent_id']]]
+    for name in initial_feature_stage_names:
+        feature_dfs.append(align_to_records(load_stage_data(output_folder, name), record_ids, name=name,
+                                            validate=validate))
+    df_out = pd.concat(feature_dfs, axis=1)
     print(df_out.shape)
 
-    df_out.to_csv(f'{output_folder}/merged_initial_features.csv', sep='|', index=False)
+    if validate and df_out.columns.duplicated().any():
+        raise ValueError(f'feature columns in more than one table: '
+                         f'{sorted(set(df_out.columns[df_out.columns.duplicated()]))}')
+    # keeps the first copy if a column does come from several tables
+    df_out = df_out.loc[:, ~df_out.columns.duplicated()]
 
-    print(df.columns.tolist())
-    print(df_out.columns.tolist())
-    print(set(df.columns.tolist()) & set(df_out.columns.tolist()))
-    df_out = df_out.merge(df)
-    df_out.to_csv(f'{output_folder}/merged_initial_features_and_data.csv', sep='|', index=False)
+    save_stage_data(df_out, output_folder, 'merged_initial_features')
+
+    df_out = pd.concat([df_out, df.drop(['record_id', 'fighter_id', 'opponent_id'], axis=1)], axis=1)
+    print(df_out.shape)
+    save_stage_data(df_out, output_folder, 'merged_initial_features_and_data')
+
+
+def get_category_indicators(s, min_perc, prefix):
+    '''
+    int8 0/1 column for every value making up at least min_perc of s, built from one comparison of the category codes
+    '''
+    s = s.astype('category')
+    value_percs = s.value_counts(normalize=True)
+    values = [v for v, v_perc in value_percs.items() if v_perc >= min_perc]
+    value_codes = s.cat.categories.get_indexer(values)
+    indicators = (s.cat.codes.to_numpy()[:, None] == value_codes[None, :]).astype(np.int8)
+    return pd.DataFrame(indicators, columns=[f'{prefix}{v}' for v in values], index=s.index)
+
+
+def get_prior_window_means(df, group_positions, columns, window_sizes, prefix=''):
+    '''
+    Mean of each column over the group's previous w rows for every window size w, the same as a per group
+    shift(1).rolling(w).mean(): NaN while the group has fewer than w earlier rows or one of them is missing.
+
+    df must be in timeline order (sorted by group and then time) and group_positions holds each row's position in its
+    group. Window sums come from differences of one cumulative sum over the whole frame, valid since a window that
+    does not cross into the previous group only spans rows of its own group, so each extra window size costs a couple
+    of array subtractions.
+    '''
+    rows = np.arange(df.shape[0])
+    output = dict()
+
+    # integer columns (the int8 category indicators) can not be missing, so they skip the missing value counts and
+    # are summed as ints without being converted to a float copy first
+    int_columns = [c for c in columns if pd.api.types.is_integer_dtype(df[c])]
+    float_columns = [c for c in columns if c not in int_columns]
+    for block_columns in [float_columns, int_columns]:
+        if not block_columns:
+            continue
+        if block_columns is int_columns:
+            values = df[block_columns].to_numpy()
+            value_sums = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64),
+                                    np.cumsum(values, axis=0, dtype=np.int64)])
+            valid_counts = None
+        else:
+            values = df[block_columns].to_numpy(dtype=np.float64)
+            valid = ~np.isnan(values)
+            value_sums = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(np.where(valid, values, 0), axis=0)])
+            valid_counts = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64), np.cumsum(valid, axis=0)])
+        del values
+
+        for w in window_sizes:
+            window_starts = np.maximum(rows - w, 0)
+            means = (value_sums[rows] - value_sums[window_starts]) / w
+            means[group_positions < w] = np.nan
+            if valid_counts is not None:
+                means[valid_counts[rows] - valid_counts[window_starts] < w] = np.nan
+            for n, c in enumerate(block_columns):
+                output[f'{prefix}{c}_{w}'] = means[:, n]
+    output_columns = [f'{prefix}{c}_{w}' for w in window_sizes for c in columns]
+    return pd.DataFrame(output, index=df.index)[output_columns]
 
 
 def build_moving_avg_features(run_id, min_perc=.04):
     print('build_moving_avg_features')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_initial_features_and_data.csv', sep='|')
-    df = df.sort_values('fight_dt')
-    added_cols = set()
-    print(df.shape)
-
     mov_avg_cols_cat_cols = ['general_method', 'event_org', 'method_details']
     mov_avg_cols = ['fight_end_time', 'result', 'fight_end_round', 'fighter_days_since_last_fight']
 
-    for c in mov_avg_cols_cat_cols:
-        value_counts_series = df[c].value_counts(normalize=True)
-        for v, v_perc in zip(value_counts_series.index, value_counts_series):
-            if v_perc >= min_perc:
-                col_name = f'cat_{c}_{v}'
-                df[col_name] = df[c].apply(lambda x: 1 if x == v else 0)
-                mov_avg_cols.append(col_name)
-
-    window_sizes = [1, 2, 3, 5, 8]
-    fighter_ids = set(df['fighter_id'])
-
-    fighter_id_dict = dict(df['fighter_id'].value_counts())
-    # for fighter_id in tqdm.tqdm(fighter_ids):
-    #     fighter_id_dict[fighter_id] = df[df['fighter_id'] == fighter_id].shape[0]
-
-    for fighter_id in tqdm.tqdm(fighter_ids):
-        for w in window_sizes:
-            if fighter_id_dict[fighter_id] <= w:
-                continue
-            for c in mov_avg_cols:
-                df.loc[df['fighter_id'] == fighter_id, f'fighter_moving_average_{c}_{w}'] = \
-                df.loc[df['fighter_id'] == fighter_id].shift(periods=1).rolling(window=w)[c].mean()
-                # df.loc[df['opponent_id'] == fighter_id, f'opponent_moving_average_{c}_{w}'] = \
-                # df.loc[df['opponent_id'] == fighter_id].shift(periods=1).rolling(window=w)[c].mean()
-
-                # df[f'fighter_moving_average_{c}_{w}'] = df[f'fighter_moving_average_{c}_{w}'].fillna(0)
-                # df[f'opponent_moving_average_{c}_{w}'] = df[f'opponent_moving_average_{c}_{w}'].fillna(0)
-
-                # df[f'diff_moving_average_{c}_{w}'] = df[f'fighter_moving_average_{c}_{w}'] - df[
-                #     f'opponent_moving_average_{c}_{w}']
-                # added_cols.update({f'fighter_moving_average_{c}_{w}', f'opponent_moving_average_{c}_{w}',
-                #                    f'diff_moving_average_{c}_{w}'})
-                added_cols.add(f'fighter_moving_average_{c}_{w}')
+    df = load_stage_data(output_folder, 'merged_initial_features_and_data',
+                         columns=['record_id', 'fighter_id', 'fight_dt'] + mov_avg_cols_cat_cols + mov_avg_cols)
     print(df.shape)
 
-    for w in window_sizes:
-        for c in mov_avg_cols:
-            df[f'fighter_moving_average_{c}_{w}'] = df[f'fighter_moving_average_{c}_{w}'].fillna(0)
-
-    if 'temp_col' in df.columns:
-        df = df.drop('temp_col', axis=1)
+    indicator_dfs = [get_category_indicators(df[c], min_perc, f'cat_{c}_') for c in mov_avg_cols_cat_cols]
+    mov_avg_cols.extend([c for i in indicator_dfs for c in i.columns])
+    df = pd.concat([df.drop(mov_avg_cols_cat_cols, axis=1)] + indicator_dfs, axis=1)
 
+    window_sizes = [1, 2, 3, 5, 8]
+    timeline = get_fighter_timeline(output_folder, df)
+    df = df.iloc[timeline.order]
+    moving_avg_df = get_prior_window_means(df, timeline.get_positions(), mov_avg_cols, window_sizes,
+                                           prefix='fighter_moving_average_').fillna(0)
+    df = pd.concat([df[['record_id']], moving_avg_df], axis=1)
     print(df.shape)
-    df = df[['record_id'] + list(added_cols)]
-    print(df.shape)
-    df.to_csv(f'{output_folder}/moving_avg_features.csv', sep='|', index=False)
+    save_stage_data(df, output_folder, 'moving_avg_features')
 
 
-def build_opponent_features(run_id):
-    print('past_opponent_features')
-    output_folder = f'{base_output_folder}/{run_id}'
-    fight_df = pd.read_csv(f'{output_folder}/merged_fight_data.csv', sep='|')
-    fight_df_map_table = fight_df[['fighter_id', 'opponent_id', 'record_id']]
+def get_mirror_rows(df):
+    '''
+    Row of the same fight seen from the opponent's side for every row of df (fight_id, fighter_id, opponent_id),
+    -1 when the opponent's record is not in df. Found by a sorted search on (fight, fighter) keys.
+    '''
+    fighter_count = max(df['fighter_id'].max(), df['opponent_id'].max()) + 1
+    fight_ids = df['fight_id'].to_numpy().astype(np.int64)
+    keys = fight_ids * fighter_count + df['fighter_id'].to_numpy()
+    mirror_keys = fight_ids * fighter_count + df['opponent_id'].to_numpy()
 
-    features = pd.read_csv(f'{output_folder}/merged_initial_features.csv', sep='|')
-    features = features[[i for i in features.columns if 'fighter_' in i or '_id' in i]]
-    fight_df_map_table = fight_df_map_table.merge(features)
-    fight_df1 = fight_df_map_table.merge(features)
+    key_order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[key_order]
+    positions = np.minimum(np.searchsorted(sorted_keys, mirror_keys), len(keys) - 1)
+    return np.where(sorted_keys[positions] == mirror_keys, key_order[positions], -1)
 
-    fight_df_map_table2 = fight_df.copy()
-    fight_df_map_table2['temp_col'] = fight_df_map_table2['fighter_id']
-    fight_df_map_table2['fighter_id'] = fight_df_map_table2['opponent_id']
-    fight_df_map_table2['opponent_id'] = fight_df_map_table2['temp_col']
-    fight_df2 = fight_df_map_table2.merge(features)
 
-    features_opponent = pd.read_csv(f'{output_folder}/merged_initial_features.csv', sep='|')
-    fight_df_copy = fight_df.copy()
+def save_mirror_rows(output_folder, df=None):
+    if df is None:
+        df = load_stage_data(output_folder, 'merged_fight_data', columns=['fight_id', 'fighter_id', 'opponent_id'])
+    np.save(f'{output_folder}/{mirror_rows_file_name}', get_mirror_rows(df))
 
 
-    features_opponent.columns = [i if 'fighter_' not in i and '_id' not in i else i.replace('fighter_', 'opponent_') for i in features_opponent.columns]
-    features_opponent = features_opponent[[i for i in features_opponent.columns if 'opponent_' in i or '_id' in i]]
-    features_opponent
+def load_mirror_rows(output_folder, df):
+    '''
+    The mirror rows saved by merge_fighter_data if they still fit df, otherwise computed from df.
+    '''
+    path = f'{output_folder}/{mirror_rows_file_name}'
+    if os.path.exists(path):
+        mirror_rows = np.load(path)
+        found = mirror_rows >= 0
+        if len(mirror_rows) == df.shape[0] and np.array_equal(df['fight_id'].values[mirror_rows[found]],
+                                                              df['fight_id'].values[found]):
+            return mirror_rows
+    return get_mirror_rows(df)
 
-    fight_df = fight_df.drop_duplicates()
 
+def build_opponent_features(run_id):
+    '''
+    Pairs every record's fighter features with its opponent's, read from the mirrored record of the same fight, and
+    adds their differences. One gather and one subtraction cover every feature column.
+    '''
+    print('past_opponent_features')
+    output_folder = f'{base_output_folder}/{run_id}'
+    fight_df = load_stage_data(output_folder, 'merged_fight_data',
+                               columns=['record_id', 'fight_id', 'fighter_id', 'opponent_id'])
+    mirror_rows = load_mirror_rows(output_folder, fight_df)
+
+    features = load_stage_data(output_folder, 'merged_initial_features')
+    fighter_columns = [i for i in features.columns if 'fighter' in i and '_id' not in i]
+    if not np.array_equal(features['record_id'].values, fight_df['record_id'].values):
+        features = align_to_records(features, fight_df['record_id'].values, name='merged_initial_features')
+
+    fighter_values = features[fighter_columns].to_numpy(dtype=np.float64)
+    opponent_values = fighter_values[np.maximum(mirror_rows, 0)]
+    opponent_values[mirror_rows == -1] = np.nan
+    diff_values = fighter_values - opponent_values
+
+    output = {'record_id': fight_df['record_id'].values}
+    for n, i in enumerate(fighter_columns):
+        j = i.replace('fighter_', 'opponent_')
+        output[i] = fighter_values[:, n]
+        output[j] = opponent_values[:, n]
+        output[f'diff_{i}_{j}'] = diff_values[:, n]
+    fight_df = pd.DataFrame(output)
     print(fight_df.shape)
-    fight_df = fight_df.merge(features_fighter, how = 'left', on = ['record_id', 'fighter_id'])
-    print(fight_df.shape)
-    fight_df = fight_df.merge(features_opponent, how = 'left', on = ['record_id', 'opponent_id'])
-    print(fight_df.shape, fight_df.columns.tolist())
-
-    added_columns = ['record_id']
-
-    for i, j in zip(features_fighter.columns, features_opponent.columns):
-        print(i, j, '_id' not in i and 'fighter' in i)
-        if '_id' not in i and 'fighter' in i:
-            new_col_name = f'diff_{i}_{j}'
-            added_columns.extend([i, j, new_col_name])
-            fight_df[new_col_name] = fight_df[i] - fight_df[j]
-    fight_df = fight_df[added_columns]
-    fight_df.to_csv(f'{output_folder}/combined_fighter_and_opponent_features.csv', sep='|', index=False)
+    save_stage_data(fight_df, output_folder, 'combined_fighter_and_opponent_features')
 
 
 def feature_extraction(run_id):
     print('feature_extraction')
     output_folder = f'{base_output_folder}/{run_id}'
-    df = pd.read_csv(f'{output_folder}/merged_initial_features_and_data.csv', sep='|')
-    features = pd.read_csv(f'{output_folder}/combined_fighter_and_opponent_features.csv', sep='|')
+    df = load_stage_data(output_folder, 'merged_initial_features_and_data',
+                         columns=['result', 'general_method', 'fight_end_round', 'record_id'])
+    features = load_stage_data(output_folder, 'combined_fighter_and_opponent_features')
 
     # moving_avg_features = pd.read_csv(f'{output_folder}/moving_avg_features.csv', sep='|')
     #
@@ -618,16 +1282,52 @@ def feature_extraction(run_id):
     # print(f'df shape: {df.shape}, features shape: {features.shape}, moving_avg_features shape: {moving_avg_features.shape}')
 
     targets = df[['result', 'general_method', 'fight_end_round', 'record_id']]
-    features.to_csv(f'{output_folder}/final_features.csv', index=False, sep='|')
-    targets.to_csv(f'{output_folder}/final_target.csv', index=False, sep='|')
+    save_stage_data(features, output_folder, 'final_features')
+    save_stage_data(targets, output_folder, 'final_target')
     print(features.shape, targets.shape)
 
 
-def feature_evaluation(run_id):
+def get_univariate_regressions(x, y):
+    '''
+    stats.linregress of y on every column of x at once, from one product of the centered matrix with the centered
+    target. Constant columns get NaN.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    row_count = x.shape[0]
+    x_mean = x.mean(axis=0)
+    y_mean = y.mean()
+    x_centered = x - x_mean
+    y_centered = y - y_mean
+
+    ssxm = np.einsum('ij,ij->j', x_centered, x_centered) / row_count
+    ssym = y_centered @ y_centered / row_count
+    ssxym = x_centered.T @ y_centered / row_count
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r_value = np.clip(ssxym / np.sqrt(ssxm * ssym), -1.0, 1.0)
+        slope = ssxym / ssxm
+        intercept = y_mean - slope * x_mean
+        degrees_of_freedom = row_count - 2
+        t = r_value * np.sqrt(degrees_of_freedom / ((1.0 - r_value) * (1.0 + r_value) + 1e-20))
+        p_value = 2 * stats.t.sf(np.abs(t), degrees_of_freedom)
+        std_err = np.sqrt((1 - r_value ** 2) * ssym / ssxm / degrees_of_freedom)
+    return pd.DataFrame({'slope': slope,
+                         'intercept': intercept,
+                         'r_value': r_value,
+                         'p_value': p_value,
+                         'std_err': std_err})
+
+
+def feature_evaluation(run_id, n_jobs=feature_evaluation_n_jobs, max_samples=feature_evaluation_max_samples):
+    '''
+    :param n_jobs: processes for the random forest, -1 for every core
+    :param max_samples: rows each tree is fit on, None for a full bootstrap sample
+    '''
     print('feature_evaluation')
     output_folder = f'{base_output_folder}/{run_id}'
-    x_df = pd.read_csv(f'{output_folder}/final_features.csv', sep='|')
-    y_df = pd.read_csv(f'{output_folder}/final_target.csv', sep='|')
+    x_df = load_stage_data(output_folder, 'final_features')
+    y_df = load_stage_data(output_folder, 'final_target')
 
     x_df = x_df.sort_values('record_id')
     y_df = y_df.sort_values('record_id')
@@ -636,48 +1336,160 @@ def feature_evaluation(run_id):
     y = y_df['result']
 
     x_df = x_df.fillna(x_df.median())
+    x_df = x_df.select_dtypes(include='number')
+
+    feature_evaluation_df = get_univariate_regressions(x_df.values, y.values)
+    feature_evaluation_df.insert(0, 'column', x_df.columns)
+
+    if max_samples and max_samples >= x_df.shape[0]:
+        max_samples = None
+    rf = RandomForestRegressor(n_jobs=n_jobs, max_samples=max_samples)
+    rf.fit(x_df.fillna(0), y)
+    feature_evaluation_df['tree_model_gain'] = rf.feature_importances_
 
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    x_df = x_df.select_dtypes(include=numerics)
-
-    feature_evaluation = dict()
-    for c in x_df.columns:
-        slope, intercept, r_value, p_value, std_err = stats.linregress(x_df[c], y)
-        feature_evaluation[c] = {'column': c,
-                                 'slope': slope,
-                                 'intercept': intercept,
-                                 'r_value': r_value,
-                                 'p_value': p_value,
-                                 'std_err': std_err
-                                 }
-
-    rf = RandomForestRegressor()
-    rf.fit(x_df, y)
-    for c, v in zip(x_df.columns, rf.feature_importances_):
-        feature_evaluation[c]['tree_model_gain'] = v
-
-    feature_evaluation_df = pd.DataFrame.from_dict(list(feature_evaluation.values()))
     feature_evaluation_df.to_csv(f'{output_folder}/feature_evaluation.csv', index=False, sep='|')
 
 
-def run_data_pipeline(run_id = None, rescrape = False, scrape_iterations = 100):
+def get_pipeline_stages(run_id, id_mode=id_mode_hash, use_saved_ratings_data=False, min_perc=.01, chunk_size=None,
+                        validate_features=False):
+    output_folder = f'{base_output_folder}/{run_id}'
+
+    def stage_files(*names):
+        return [get_stage_path(output_folder, i) for i in names]
+
+    return [
+        {'name': 'prepare_data',
+         'function': prepare_data,
+         'kwargs': {'run_id': run_id, 'sample': False, 'id_mode': id_mode, 'chunk_size': chunk_size},
+         'inputs': [f'{output_folder}/personal_data.csv', f'{output_folder}/fight_data.csv'],
+         'outputs': stage_files('processed_fighter_data', 'processed_fight_data')},
+        {'name': 'merge_fighter_data',
+         'function': merge_fighter_data,
+         'kwargs': {'run_id': run_id, 'chunk_size': chunk_size},
+         'inputs': stage_files('processed_fighter_data', 'processed_fight_data'),
+         'outputs': stage_files('merged_fight_data')},
+        {'name': 'calculate_all_ratings',
+         'function': calculate_all_ratings,
+         'kwargs': {'run_id': run_id, 'min_perc': min_perc, 'use_saved_data': use_saved_ratings_data},
+         'inputs': stage_files('processed_fight_data'),
+         'outputs': stage_files('fighter_ratings')},
+        {'name': 'build_personal_features',
+         'function': build_personal_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('personal_features')},
+        {'name': 'build_date_features',
+         'function': build_date_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('date_features')},
+        {'name': 'build_fight_timing_features',
+         'function': build_fight_timing_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('fight_timing_features')},
+        {'name': 'build_rematch_features',
+         'function': build_rematch_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('rematch_features')},
+        {'name': 'build_career_features',
+         'function': build_career_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('career_features')},
+        {'name': 'build_form_features',
+         'function': build_form_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data'),
+         'outputs': stage_files('form_features')},
+        {'name': 'merge_initial_features',
+         'function': merge_initial_features,
+         'kwargs': {'run_id': run_id, 'validate': validate_features},
+         'inputs': stage_files('merged_fight_data', *initial_feature_stage_names),
+         'outputs': stage_files('merged_initial_features', 'merged_initial_features_and_data')},
+        {'name': 'build_moving_avg_features',
+         'function': build_moving_avg_features,
+         'kwargs': {'run_id': run_id, 'min_perc': min_perc},
+         'inputs': stage_files('merged_initial_features_and_data'),
+         'outputs': stage_files('moving_avg_features')},
+        {'name': 'build_opponent_features',
+         'function': build_opponent_features,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_fight_data', 'merged_initial_features'),
+         'outputs': stage_files('combined_fighter_and_opponent_features')},
+        {'name': 'feature_extraction',
+         'function': feature_extraction,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('merged_initial_features_and_data', 'combined_fighter_and_opponent_features'),
+         'outputs': stage_files('final_features', 'final_target')},
+        {'name': 'feature_evaluation',
+         'function': feature_evaluation,
+         'kwargs': {'run_id': run_id},
+         'inputs': stage_files('final_features', 'final_target'),
+         'outputs': [f'{output_folder}/feature_evaluation.csv']},
+    ]
+
+
+def get_stage_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def run_stages_in_memory(stages, checkpoint_stages=()):
+    '''
+    Runs the stages in order in this process, handing stage outputs to the next stages as DataFrames.
+    Only the final features and target, outputs no other stage reads and checkpoint_stages are written to disk.
+    Each output is dropped from memory once the last stage reading it is done.
+    '''
+    global in_memory_stage_data, in_memory_persisted_stages
+
+    last_reader = dict()
+    for n, stage in enumerate(stages):
+        for i in stage['inputs']:
+            last_reader[get_stage_name(i)] = n
+    output_names = [get_stage_name(o) for stage in stages for o in stage['outputs']]
+
+    in_memory_stage_data = dict()
+    in_memory_persisted_stages = set(final_stage_names) | set(checkpoint_stages) | \
+                                 {i for i in output_names if i not in last_reader}
+    try:
+        for n, stage in enumerate(stages):
+            print(f'running stage {stage["name"]} in memory')
+            stage['function'](**stage['kwargs'])
+            for name in [k for k in in_memory_stage_data if last_reader.get(k, n) <= n]:
+                del in_memory_stage_data[name]
+    finally:
+        in_memory_stage_data = None
+        in_memory_persisted_stages = set()
+
+
+def run_data_pipeline(run_id = None, rescrape = False, scrape_iterations = 100, id_mode=id_mode_hash, max_workers=None,
+                      force_stages=(), in_memory=False, checkpoint_stages=(), chunk_size=None,
+                      validate_features=False):
+    '''
+    Runs the stage graph from get_pipeline_stages, skipping stages whose inputs, parameters and code are unchanged
+    since their last run and running independent stages on up to max_workers processes.
+
+    With in_memory set, every stage runs in this process and intermediate stage outputs are passed along in memory
+    instead, only the final outputs and checkpoint_stages are saved.
+
+    With chunk_size set, prepare_data and merge_fighter_data stream the fight rows chunk_size rows at a time.
+    With validate_features set, merge_initial_features checks every feature table lines up with the fight records,
+    and with chunk_size also set, check_chunked_merge first checks the chunked merge matches the unchunked one.
+    '''
     if not run_id or rescrape:
         run_id = run_scrape(run_id = run_id, max_iterations=scrape_iterations)
-    prepare_data(run_id=run_id, sample=False)
-    merge_fighter_data(run_id=run_id)
-
-    use_saved_ratings_data = run_id and not rescrape
-    calculate_all_ratings(run_id=run_id, min_perc=.01, use_saved_data=use_saved_ratings_data)
-
-    build_personal_features(run_id=run_id)
-    build_date_features(run_id=run_id)
-    build_fight_timing_features(run_id=run_id)
-    build_rematch_features(run_id=run_id)
-    merge_initial_features(run_id=run_id)
-    build_moving_avg_features(run_id=run_id, min_perc=.01)
-    build_opponent_features(run_id=run_id)
-    feature_extraction(run_id=run_id)
-    feature_evaluation(run_id=run_id)
+    if chunk_size and validate_features:
+        check_chunked_merge(run_id, chunk_size, id_mode=id_mode)
+
+    use_saved_ratings_data = bool(run_id and not rescrape)
+    stages = get_pipeline_stages(run_id, id_mode=id_mode, use_saved_ratings_data=use_saved_ratings_data,
+                                 chunk_size=chunk_size, validate_features=validate_features)
+    if in_memory:
+        run_stages_in_memory(stages, checkpoint_stages=checkpoint_stages)
+        return
+    run_stage_graph(stages, f'{base_output_folder}/{run_id}', max_workers=max_workers or pipeline_max_workers,
+                    force_stages=force_stages)
 
 
 def scratch():
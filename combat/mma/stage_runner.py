@@ -0,0 +1,162 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import inspect
+import pickle
+import os
+
+fingerprint_file_name = 'stage_fingerprints.pkl'
+
+
+def get_file_hash(path, file_hash_cache):
+    '''
+    md5 of the file contents, reusing the hash recorded for the same path, size and mtime.
+    '''
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime)
+    if cache_key not in file_hash_cache:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        file_hash_cache[cache_key] = md5.hexdigest()
+    return file_hash_cache[cache_key]
+
+
+def get_class_functions(cls):
+    functions = []
+    for v in vars(cls).values():
+        if isinstance(v, (classmethod, staticmethod)):
+            v = v.__func__
+        elif isinstance(v, property):
+            v = v.fget
+        if inspect.isfunction(v):
+            functions.append(v)
+    return functions
+
+
+def get_code_sources(obj, sources=None):
+    '''
+    Source of a function or class plus every function, class and simple constant it references that lives next to
+    it in this project, followed recursively (through every method of a class), so a change to a helper invalidates
+    the stages that use it.
+    '''
+    if sources is None:
+        sources = dict()
+    key = f'{obj.__module__}.{obj.__qualname__}'
+    if key in sources:
+        return sources
+    sources[key] = inspect.getsource(obj)
+
+    functions = get_class_functions(obj) if inspect.isclass(obj) else [obj]
+    project_folder = os.path.dirname(os.path.abspath(inspect.getsourcefile(obj)))
+    for func in functions:
+        names = set()
+        codes = [func.__code__]
+        while codes:
+            c = codes.pop()
+            names.update(c.co_names)
+            codes.extend([i for i in c.co_consts if inspect.iscode(i)])
+
+        for n in sorted(names):
+            g = func.__globals__.get(n)
+            if inspect.isfunction(g) or inspect.isclass(g):
+                try:
+                    source_file = inspect.getsourcefile(g)
+                except TypeError:
+                    # builtin classes have no source file
+                    continue
+                if source_file and os.path.dirname(os.path.abspath(source_file)) == project_folder:
+                    get_code_sources(g, sources)
+            elif isinstance(g, (int, float, str, list, tuple, dict)):
+                sources[f'{func.__module__}.{n}'] = repr(g)
+    return sources
+
+
+def get_stage_fingerprint(stage, file_hash_cache):
+    md5 = hashlib.md5()
+    for k, v in sorted(get_code_sources(stage['function']).items()):
+        md5.update(k.encode())
+        md5.update(v.encode())
+    md5.update(repr(sorted(stage['kwargs'].items())).encode())
+    for i in stage['inputs']:
+        md5.update(os.path.basename(i).encode())
+        md5.update(get_file_hash(i, file_hash_cache).encode())
+    return md5.hexdigest()
+
+
+def load_fingerprints(output_folder):
+    path = f'{output_folder}/{fingerprint_file_name}'
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    return {'stages': dict(), 'files': dict()}
+
+
+def save_fingerprints(output_folder, fingerprints):
+    with open(f'{output_folder}/{fingerprint_file_name}', 'wb') as f:
+        pickle.dump(fingerprints, f)
+
+
+def run_stage_graph(stages, output_folder, max_workers=1, force_stages=()):
+    '''
+    Runs a graph of pipeline stages, each a dict with:
+        name: stage name
+        function: module level function called as function(**kwargs)
+        kwargs: keyword arguments, part of the fingerprint
+        inputs: files the stage reads
+        outputs: files the stage writes
+
+    A stage depends on the stages that write its inputs. Its fingerprint covers its code (including helpers), kwargs
+    and the contents of its inputs. Stages whose fingerprint matches the last successful run and whose outputs exist
+    are skipped. Stages whose dependencies are done run in parallel on up to max_workers processes.
+    '''
+    fingerprints = load_fingerprints(output_folder)
+    producers = {o: s['name'] for s in stages for o in s['outputs']}
+    dependencies = {s['name']: {producers[i] for i in s['inputs'] if i in producers} for s in stages}
+
+    pending = list(stages)
+    running = dict()
+    done = set()
+    error = None
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            scheduled = error is None
+            while scheduled:
+                scheduled = False
+                for stage in list(pending):
+                    if not dependencies[stage['name']] <= done:
+                        continue
+                    pending.remove(stage)
+                    scheduled = True
+
+                    fingerprint = get_stage_fingerprint(stage, fingerprints['files'])
+                    outputs_exist = all(os.path.exists(o) for o in stage['outputs'])
+                    if stage['name'] not in force_stages and outputs_exist and \
+                            fingerprints['stages'].get(stage['name']) == fingerprint:
+                        print(f'skipping stage {stage["name"]}, inputs, parameters and code unchanged')
+                        done.add(stage['name'])
+                        continue
+
+                    print(f'running stage {stage["name"]}')
+                    running[executor.submit(stage['function'], **stage['kwargs'])] = (stage, fingerprint)
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint = running.pop(future)
+                if future.exception() is not None:
+                    # let the stages already running finish and keep their fingerprints, then fail
+                    print(f'stage {stage["name"]} failed')
+                    error = error or future.exception()
+                    continue
+                fingerprints['stages'][stage['name']] = fingerprint
+                save_fingerprints(output_folder, fingerprints)
+                done.add(stage['name'])
+
+    if error is not None:
+        raise error
+    if pending:
+        raise ValueError(f'stages with unmet dependencies: {[s["name"] for s in pending]}')
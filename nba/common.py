@@ -4,6 +4,8 @@ import requests
 from bs4 import BeautifulSoup
 import threading
 import sys
+import numpy as np
+import pandas as pd
 
 
 
@@ -33,6 +35,8 @@ past_n_game_dataset_combined_table_name = 'past_n_game_dataset_combined'
 
 date_record_pickle_file_name = 'scraped_dates'
 box_score_record_pickle_file_name = 'scraped_games'
+scrape_journal_file_name = 'scrape_journal'
+season_shard_folder_name = 'season_shards'
 max_tries = 5
 file_lock = threading.Lock()
 
@@ -43,6 +47,26 @@ rating_ceiling = 10000
 rating_d = 1000
 k_min_sensitivity = 1
 
+# text columns repeated on every game/player row, loaded as categoricals
+# dtypes applied to the box score tables as they are loaded. The team/opponent links stay text since they are
+# groupby keys whose missing values are filled. Float columns not listed are read as float32 and every other column
+# keeps the type read_csv infers.
+table_schema = {'box_score_url': 'category',
+                'team_tag': 'category',
+                'team_name': 'category',
+                'opponent_tag': 'category',
+                'opponent_name': 'category',
+                'location': 'category',
+                'player_link': 'category',
+                'player_name': 'category',
+                'year': 'int16',
+                'month': 'int8',
+                'day': 'int8',
+                'win': 'int8',
+                'home': 'int8',
+                'date_dt': 'datetime64[ns]'}
+compact_float_dtype = np.float32
+
 
 def timeit(method):
     def timed(*args, **kw):
@@ -59,6 +83,36 @@ def timeit(method):
     return timed
 
 
+def get_memory_usage_mb(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def optimize_dtypes(df, name=''):
+    '''
+    Converts a loaded table to the dtypes in table_schema in place, one column at a time, and the other float
+    columns to float32. Listed int columns are only converted when read_csv read them as ints, that is with no
+    missing values. Prints the table's memory footprint before and after.
+    '''
+    memory_before = get_memory_usage_mb(df)
+    for c in df.columns:
+        dtype = table_schema.get(c)
+        if dtype == 'category':
+            df[c] = df[c].astype('category')
+        elif dtype == 'datetime64[ns]':
+            df[c] = pd.to_datetime(df[c], errors='coerce')
+        elif dtype is not None:
+            if pd.api.types.is_integer_dtype(df[c]):
+                df[c] = df[c].astype(dtype)
+        elif pd.api.types.is_float_dtype(df[c]):
+            df[c] = df[c].astype(compact_float_dtype)
+    print(f'{name} {df.shape}: {memory_before:.1f} MB -> {get_memory_usage_mb(df):.1f} MB')
+    return df
+
+
+def read_table(path, name=''):
+    return optimize_dtypes(pd.read_csv(path, sep='|', low_memory=False), name=name)
+
+
 def clean_text(s):
     return str(s).replace('|', ' ')
 
@@ -83,6 +137,23 @@ def sleep_random_amount(min_time=.05, max_time=.2, mu=None, sigma=1.0, verbose=F
     time.sleep(sleep_time)
 
 
+class RateLimiter:
+    '''
+    Spaces out requests made from any number of threads so that together they stay under requests_per_second.
+    '''
+    def __init__(self, requests_per_second):
+        self.min_interval = 1.0 / requests_per_second
+        self.next_request_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            request_time = max(now, self.next_request_time)
+            self.next_request_time = request_time + self.min_interval
+        time.sleep(max(request_time - now, 0))
+
+
 def get_session():
     session = requests.Session()
     session.headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/75.0.3770.100 Safari/537.36'}
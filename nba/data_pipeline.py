@@ -4,6 +4,7 @@ from nba.common import (
     starting_rating,
     get_new_rating,
     timeit,
+    read_table,
     parse_minutes_played,
     box_score_details_table_name,
     player_detail_table_name,
@@ -33,8 +34,8 @@ import gc
 
 @timeit
 def get_raw_data(sample):
-    team_df = pd.read_csv(f'{data_path}/{box_score_details_table_name}.csv', sep='|', low_memory=False)
-    player_df = pd.read_csv(f'{data_path}/{player_detail_table_name}.csv', sep='|', low_memory=False)
+    team_df = read_table(f'{data_path}/{box_score_details_table_name}.csv', name='team data')
+    player_df = read_table(f'{data_path}/{player_detail_table_name}.csv', name='player data')
     print(f'team df shape: {team_df.shape}, player df shape: {player_df.shape}')
     if sample:
         team_df = team_df[(team_df['year'] >= 2019) & (team_df['month'] >= 3)]
@@ -172,8 +173,8 @@ def process_raw_data(sample=False):
 
 @timeit
 def get_processed_data():
-    team_df = pd.read_csv(f'{data_path}/{processed_team_data_table_name}.csv', sep='|', low_memory=False)
-    player_df = pd.read_csv(f'{data_path}/{processed_player_data_table_name}.csv', sep='|', low_memory=False)
+    team_df = read_table(f'{data_path}/{processed_team_data_table_name}.csv', name='processed team data')
+    player_df = read_table(f'{data_path}/{processed_player_data_table_name}.csv', name='processed player data')
     return team_df, player_df
 
 
@@ -236,7 +237,7 @@ def build_team_aggregates(team_df, history_length_list, team_columns_to_aggregat
     team_df = pd.concat(list(team_aggregate_dict.values()))
     team_df = team_df.reset_index()
 
-    team_df = team_df.fillna(0)
+    team_df = fill_non_categorical_nans(team_df, 0)
 
     new_features = list(new_features)
     return team_df, new_features
@@ -286,10 +287,19 @@ def compare_features_to_opponent(df, columns_to_compare):
     return df, new_features
 
 
+def fill_non_categorical_nans(df, value):
+    '''
+    fillna on every column but the categoricals, which can not take a value outside their categories.
+    '''
+    columns = [c for c in df.columns if not isinstance(df[c].dtype, pd.CategoricalDtype)]
+    df[columns] = df[columns].fillna(value)
+    return df
+
+
 @timeit
 def fill_nans(df):
     # TODO: add subset na filling
-    return df.fillna(df.median())
+    return df.fillna(df.median(numeric_only=True))
 
 
 @timeit
@@ -302,17 +312,13 @@ def scale_data(feature_df, columns_to_scale):
 
 
 def get_player_game_aggregates(team_df, player_df, player_columns_to_aggregate):
-    player_df = player_df.fillna(0)
-    player_df_group_avg = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[
-        player_columns_to_aggregate].mean()
-    player_df_group_var = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[
-        player_columns_to_aggregate].var()
-    player_df_group_skew = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[
-        player_columns_to_aggregate].skew()
-    player_df_group_max = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[
-        player_columns_to_aggregate].max()
-    player_df_group_min = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[
-        player_columns_to_aggregate].min()
+    player_df = fill_non_categorical_nans(player_df, 0)
+    player_df_groups = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])
+    player_df_group_avg = player_df_groups[player_columns_to_aggregate].mean()
+    player_df_group_var = player_df_groups[player_columns_to_aggregate].var()
+    player_df_group_skew = player_df_groups[player_columns_to_aggregate].skew()
+    player_df_group_max = player_df_groups[player_columns_to_aggregate].max()
+    player_df_group_min = player_df_groups[player_columns_to_aggregate].min()
     # player_df_group_median = player_df.groupby(['team_link', 'opponent_link', 'year', 'month', 'day'])[player_columns_to_aggregate].median()
 
     player_df_group_avg.columns = [f'player_stats_aggregated_by_game_{i}_avg' for i in player_columns_to_aggregate]
@@ -491,15 +497,15 @@ def generate_time_series_features(history_lengths):
 @timeit
 def load_general_feature_file(use_standard_scaler=False):
     if use_standard_scaler:
-        feature_df = pd.read_csv(f'{data_path}/{general_feature_scaled_data_table_name}.csv', sep='|', low_memory=False)
+        feature_df = read_table(f'{data_path}/{general_feature_scaled_data_table_name}.csv', name='scaled features')
     else:
-        feature_df = pd.read_csv(f'{data_path}/{general_feature_data_table_name}.csv', sep='|', low_memory=False)
+        feature_df = read_table(f'{data_path}/{general_feature_data_table_name}.csv', name='features')
     return feature_df
 
 
 def load_time_series_data_and_target(history_lengths, target):
 
-    feature_df = pd.read_csv(f'{data_path}/{general_feature_data_table_name}.csv', sep='|', low_memory=False)
+    feature_df = read_table(f'{data_path}/{general_feature_data_table_name}.csv', name='features')
     feature_df = feature_df.sort_values('key')
 
     #keys should be stored by date
@@ -551,11 +557,10 @@ def load_time_series_data_and_target(history_lengths, target):
 @timeit
 def load_all_feature_files(history_lengths, timeseries_data_choices, general_features_encoding_lengths):
     output_dict = dict()
-    feature_df = pd.read_csv(f'{data_path}/{general_feature_data_table_name}.csv', sep='|', low_memory=False)
+    feature_df = read_table(f'{data_path}/{general_feature_data_table_name}.csv', name='features')
     feature_df = feature_df.sort_values('key')
 
-    feature_scaled_df = pd.read_csv(f'{data_path}/{general_feature_scaled_data_table_name}.csv', sep='|',
-                                    low_memory=False)
+    feature_scaled_df = read_table(f'{data_path}/{general_feature_scaled_data_table_name}.csv', name='scaled features')
     feature_scaled_df = feature_scaled_df.sort_values('key')
     for d in timeseries_data_choices:
         for h in history_lengths:
@@ -567,7 +572,7 @@ def load_all_feature_files(history_lengths, timeseries_data_choices, general_fea
 
     for i in general_features_encoding_lengths:
         if i:
-            df = pd.read_csv(f'{data_path}/{encoded_file_base_name}_pca_{i}.csv', sep='|', low_memory=False)
+            df = read_table(f'{data_path}/{encoded_file_base_name}_pca_{i}.csv', name=f'pca {i} encoding')
             df = df.set_index('key')
             df = df.sort_index()
             output_dict[f'encoded_general_features_{i}'] = df
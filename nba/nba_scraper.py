@@ -10,20 +10,31 @@ from nba.common import (sleep_on_error,
                     player_detail_table_name,
                     date_record_pickle_file_name,
                     box_score_record_pickle_file_name,
+                    scrape_journal_file_name,
+                    season_shard_folder_name,
+                    RateLimiter,
                     max_tries,
                     file_lock,
                         timeit)
 
+from nba.scrape_store import ScrapeStore
+
 from bs4 import BeautifulSoup
+from lxml import html
 import pickle
 import pandas as pd
 import copy
 import time
 import traceback
 import re
-
-def get_soup(url, session = None, sleep = True):
-    if sleep:
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def get_soup(url, session = None, sleep = True, rate_limiter = None):
+    if rate_limiter:
+        rate_limiter.wait()
+    elif sleep:
         sleep_normal()
 
     if not session:
@@ -34,68 +45,188 @@ def get_soup(url, session = None, sleep = True):
     return soup
 
 
-def process_stats_tables(t_basic, t_advanced):
-    tbody_basic = t_basic.find('tbody')
-    rows_basic = tbody_basic.find_all('tr')
-    footer_basic = t_basic.find('tfoot')
-    tbody_advanced = t_advanced.find('tbody')
-    rows_advanced = tbody_advanced.find_all('tr')
-    footer_advanced = t_advanced.find('tfoot')
+def get_page_tree(url, session = None, sleep = True, rate_limiter = None):
+    '''
+    Fetches a page and parses it once with lxml. Comment markers are stripped from the raw text first, since
+    basketball-reference ships most of its tables inside html comments.
+    '''
+    if rate_limiter:
+        rate_limiter.wait()
+    elif sleep:
+        sleep_normal()
 
-    player_data = dict()
-    team_data = dict()
+    if not session:
+        session = get_session()
 
-    td_tags = footer_basic.find_all('td')
-    for td_tag in td_tags:
-        stat_name = td_tag['data-stat']
-        stat_value = td_tag.get_text()
-        team_data[stat_name] = stat_value
-    td_tags = footer_advanced.find_all('td')
-    for td_tag in td_tags:
-        stat_name = td_tag['data-stat']
-        stat_value = td_tag.get_text()
-        team_data[stat_name] = stat_value
-
-    for r in rows_basic:
-        if len(r.find_all('th')) != 1:
-            continue
+    r = session.get(url)
+    return html.fromstring(r.text.replace('-->', '').replace('<!--', ''))
 
-        player_info = r.find('th')
-        player_link = base_url + player_info.find('a')['href']
-        player_data.setdefault(player_link, dict())
-        player_data[player_link]['player_link'] = player_link
-        player_data[player_link]['player_name'] = player_info.find('a').get_text()
 
-        td_tags = r.find_all('td')
-        for td_tag in td_tags:
-            stat_name = td_tag['data-stat']
-            stat_value = td_tag.get_text()
-            player_data[player_link][stat_name] = stat_value
+def parse_stat_value(s):
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
 
-    for r in rows_advanced:
-        if len(r.find_all('th')) != 1:
-            continue
 
-        player_info = r.find('th')
-        player_link = base_url + player_info.find('a')['href']
-        player_data.setdefault(player_link, dict())
+def get_row_stats(row):
+    return {td.get('data-stat'): parse_stat_value(td.text_content()) for td in row.iterfind('td')}
 
-        td_tags = r.find_all('td')
-        for td_tag in td_tags:
-            stat_name = td_tag['data-stat']
-            stat_value = td_tag.get_text()
-            player_data[player_link][stat_name] = stat_value
+
+def process_stats_tables(t_basic, t_advanced):
+    player_data = dict()
+    team_data = dict()
+
+    for footer in t_basic.xpath('./tfoot/tr') + t_advanced.xpath('./tfoot/tr'):
+        team_data.update(get_row_stats(footer))
+
+    for table, is_basic in [(t_basic, True), (t_advanced, False)]:
+        for r in table.xpath('./tbody/tr'):
+            player_info = r.xpath('.//th')
+            if len(player_info) != 1:
+                continue
+
+            player_a = player_info[0].xpath('.//a')[0]
+            player_link = base_url + player_a.get('href')
+            player_data.setdefault(player_link, dict())
+            if is_basic:
+                player_data[player_link]['player_link'] = player_link
+                player_data[player_link]['player_name'] = player_a.text_content()
+            player_data[player_link].update(get_row_stats(r))
     return {'player_data': player_data, 'team_data': team_data}
 
 
-def get_score_table(soup, tag, simplicity):
-    pattern = 'box[-_]+{tag}.+{simplicity}'.format(tag = tag.upper(), simplicity = simplicity)
-    table = soup.find('table', {'id':re.compile(pattern)})
-    return table
+def get_elements_by_class(tree, class_name):
+    return tree.xpath('.//*[contains(concat(" ", normalize-space(@class), " "), " {} ")]'.format(class_name))
+
+
+def convert_numeric_columns(df):
+    for c in df.columns:
+        if pd.api.types.is_numeric_dtype(df[c]):
+            continue
+        non_empty = df[c].notna() & (df[c].astype(str).str.strip() != '')
+        converted = pd.to_numeric(df[c].where(non_empty), errors='coerce')
+        if converted[non_empty].notna().all():
+            df[c] = converted
+    return df
+
+
+table_key_columns = {box_score_link_table_name: ['box_score_url'],
+                     box_score_details_table_name: ['box_score_url', 'team_tag'],
+                     player_detail_table_name: ['box_score_url', 'player_link']}
+# rows written by earlier versions of the scraper have no box_score_url, they are matched by team/player and date
+table_legacy_key_columns = {box_score_details_table_name: ['team_tag', 'year', 'month', 'day'],
+                            player_detail_table_name: ['player_link', 'year', 'month', 'day']}
+
+
+def export_store_csv(store):
+    '''
+    Writes the stored tables to the pipe delimited csv files read by data_pipeline.
+    '''
+    with file_lock:
+        for table_name in table_key_columns.keys():
+            df = store.load_frame(table_name)
+            df.to_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=table_name), index=False, sep = '|')
+
+
+def get_season_date_ranges(start_date, end_date):
+    '''
+    Splits a date range into nba seasons, labeled by the year they end in and running from August through July.
+    '''
+    season_ranges = []
+    season = start_date.year + 1 if start_date.month >= 8 else start_date.year
+    while datetime.date(season - 1, 8, 1) <= end_date:
+        season_start = max(datetime.date(season - 1, 8, 1), start_date)
+        season_end = min(datetime.date(season, 7, 31), end_date)
+        season_ranges.append((season, season_start, season_end))
+        season += 1
+    return season_ranges
+
+
+def get_key_value(v):
+    '''
+    Ints for the zero padded date strings of scraped rows and the int dates of csv loaded rows, so both key alike.
+    '''
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return v
+
+
+class RecordBuffer:
+    '''
+    Collects scraped rows in a list and flushes them in batches to typed DataFrame chunks until they are drained
+    into the ScrapeStore.
+    Rows are deduplicated on key_columns as they arrive instead of running drop_duplicates on the whole table, and
+    on legacy_key_columns against the rows imported from files without box score urls (see seed_legacy_keys).
+    '''
+    def __init__(self, key_columns, legacy_key_columns = None, flush_size = 1000):
+        self.key_columns = key_columns
+        self.legacy_key_columns = legacy_key_columns
+        self.flush_size = flush_size
+        self.rows = []
+        self.chunks = []
+        self.keys = set()
+        self.legacy_keys = set()
+
+    def get_key(self, record):
+        return tuple(record.get(c) for c in self.key_columns)
+
+    def get_legacy_key(self, record):
+        return tuple(get_key_value(record.get(c)) for c in self.legacy_key_columns)
+
+    def seed_legacy_keys(self, df):
+        if not self.legacy_key_columns or not set(self.legacy_key_columns) <= set(df.columns):
+            return
+        for r in df[self.legacy_key_columns].to_dict(orient='records'):
+            self.legacy_keys.add(self.get_legacy_key(r))
+
+    def extend(self, records):
+        for r in records:
+            key = self.get_key(r)
+            if key in self.keys:
+                continue
+            if self.legacy_keys and self.get_legacy_key(r) in self.legacy_keys:
+                continue
+            self.keys.add(key)
+            self.rows.append(r)
+        if len(self.rows) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.chunks.append(convert_numeric_columns(pd.DataFrame.from_dict(self.rows)))
+            self.rows = []
+
+    def drain(self):
+        '''
+        Returns the rows added since the last drain and releases them.
+        '''
+        self.flush()
+        if not self.chunks:
+            return pd.DataFrame()
+        df = pd.concat(self.chunks, sort = True)
+        self.chunks = []
+        return df
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def get_score_table(tree, tag, simplicity):
+    pattern = re.compile('box[-_]+{tag}.+{simplicity}'.format(tag = tag.upper(), simplicity = simplicity))
+    for table in tree.iterfind('.//table[@id]'):
+        if pattern.search(table.get('id')):
+            return table
 
 
 class Scraper:
-    def __init__(self, start_date = None, end_date = None, clear_data = False, save_frequency = 100):
+    def __init__(self, start_date = None, end_date = None, clear_data = False, save_frequency = 100, db_path = None,
+                 rate_limiter = None):
         self.end_date = end_date
         self.current_date = end_date
         self.start_date = start_date
@@ -106,57 +237,125 @@ class Scraper:
         if not start_date:
             self.start_date = datetime.date(1980, 1, 1)
 
+        # only the main store picks up files written by earlier versions of save_data
+        self.import_legacy = not db_path
+        if not db_path:
+            db_path = '{data_path}/{file_name}.db'.format(data_path=data_path, file_name=scrape_journal_file_name)
+
         self.save_frequency = save_frequency
         self.session = get_session()
-        self.box_office_links = pd.DataFrame()
-        self.box_office_details = pd.DataFrame()
-        self.player_box_office_details = pd.DataFrame()
-        self.dates_searched_for_links = []
-        self.game_links_searched = []
+        self.rate_limiter = rate_limiter
+        self.store = ScrapeStore(db_path)
+        self.box_office_links = RecordBuffer(table_key_columns[box_score_link_table_name])
+        self.box_office_details = RecordBuffer(table_key_columns[box_score_details_table_name],
+                                               table_legacy_key_columns[box_score_details_table_name])
+        self.player_box_office_details = RecordBuffer(table_key_columns[player_detail_table_name],
+                                                      table_legacy_key_columns[player_detail_table_name])
+        self.dates_searched_for_links = set()
+        self.game_links_searched = set()
+        self.unsaved_dates_searched_for_links = []
+        self.unsaved_game_links_searched = []
+        self.pending_box_score_links = deque()
 
         if clear_data:
-            self.save_data()
+            # a cleared store is empty, which would otherwise trigger the legacy file import in load_data
+            self.store.clear()
+            self.import_legacy = False
         self.load_data()
 
     @timeit
     def save_data(self):
+        '''
+        Appends only the links, box scores and searched dates/games found since the last save, in one transaction.
+        '''
         with file_lock:
-            with open('{data_path}/{file_name}.pkl'.format(data_path=data_path, file_name=date_record_pickle_file_name), 'wb') as f:
-                pickle.dump(self.dates_searched_for_links, f)
-            with open('{data_path}/{file_name}.pkl'.format(data_path=data_path, file_name=box_score_record_pickle_file_name),
-                      'wb') as f:
-                    pickle.dump(self.game_links_searched, f)
-            self.box_office_links.to_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_link_table_name), index=False, sep = '|')
-            self.box_office_details.to_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_details_table_name), index=False, sep = '|')
-            self.player_box_office_details.to_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=player_detail_table_name), index=False, sep = '|')
-
-            with open('{data_path}/{file_name}_backup.pkl'.format(data_path=data_path, file_name=date_record_pickle_file_name), 'wb') as f:
-                pickle.dump(self.dates_searched_for_links, f)
-            with open('{data_path}/{file_name}_backup.pkl'.format(data_path=data_path, file_name=box_score_record_pickle_file_name),
-                      'wb') as f:
-                    pickle.dump(self.game_links_searched, f)
-            self.box_office_links.to_csv('{data_path}/{db_name}_backup.csv'.format(data_path=data_path, db_name=box_score_link_table_name), index=False, sep = '|')
-            self.box_office_details.to_csv('{data_path}/{db_name}_backup.csv'.format(data_path=data_path, db_name=box_score_details_table_name), index=False, sep = '|')
-            self.player_box_office_details.to_csv('{data_path}/{db_name}_backup.csv'.format(data_path=data_path, db_name=player_detail_table_name), index=False, sep = '|')
+            self.store.save([(box_score_link_table_name, self.box_office_links.drain(), table_key_columns[box_score_link_table_name]),
+                             (box_score_details_table_name, self.box_office_details.drain(), table_key_columns[box_score_details_table_name]),
+                             (player_detail_table_name, self.player_box_office_details.drain(), table_key_columns[player_detail_table_name])],
+                            self.unsaved_dates_searched_for_links,
+                            self.unsaved_game_links_searched)
+            self.unsaved_dates_searched_for_links = []
+            self.unsaved_game_links_searched = []
 
     @timeit
     def load_data(self):
+        with file_lock:
+            if self.import_legacy and self.store.is_empty():
+                self.import_legacy_data()
+
+            self.dates_searched_for_links = self.store.load_values(self.store.dates_table_name, 'date')
+            self.game_links_searched = self.store.load_values(self.store.games_table_name, 'box_score_url')
+            pending_links = self.store.load_frame(box_score_link_table_name,
+                                                  query='SELECT * FROM "{links}" WHERE box_score_url NOT IN (SELECT box_score_url FROM "{games}")'.format(
+                                                      links=box_score_link_table_name,
+                                                      games=self.store.games_table_name))
+        self.queue_pending_box_score_links(pending_links.to_dict(orient='records'))
+        self.box_office_details.seed_legacy_keys(self.load_legacy_keys(box_score_details_table_name))
+        self.player_box_office_details.seed_legacy_keys(self.load_legacy_keys(player_detail_table_name))
+
+    def load_legacy_keys(self, table_name):
+        '''
+        Team/player and date keys of the stored rows that have no box score url.
+        '''
+        key_columns = table_legacy_key_columns[table_name]
+        columns = self.store.get_columns(table_name)
+        if not set(key_columns) <= set(columns):
+            return pd.DataFrame()
+        key_sql = ', '.join(['"{}"'.format(c) for c in key_columns])
+        query = 'SELECT {keys} FROM "{table}"'.format(keys=key_sql, table=table_name)
+        if 'box_score_url' in columns:
+            query += ' WHERE box_score_url IS NULL'
+        return self.store.load_frame(table_name, query=query)
+
+    def import_legacy_data(self):
+        '''
+        One time import of the pickle/csv files written by earlier versions of save_data.
+        '''
         try:
-            with file_lock:
-                with open('{data_path}/{file_name}.pkl'.format(data_path=data_path,
-                                                               file_name=date_record_pickle_file_name), 'rb') as f:
-                    self.dates_searched_for_links = pickle.load(f)
-                with open('{data_path}/{file_name}.pkl'.format(data_path=data_path,
-                                                               file_name=box_score_record_pickle_file_name),
-                          'rb') as f:
-                    self.game_links_searched = pickle.load(f)
-
-                self.box_office_links = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_link_table_name), sep = '|')
-                self.box_office_details = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_details_table_name), sep = '|')
-                self.player_box_office_details = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=player_detail_table_name), sep = '|')
-                self.box_office_details.columns = [i.replace('stat_', '') for i in self.box_office_details.columns]
+            with open('{data_path}/{file_name}.pkl'.format(data_path=data_path,
+                                                           file_name=date_record_pickle_file_name), 'rb') as f:
+                dates_searched_for_links = pickle.load(f)
+            with open('{data_path}/{file_name}.pkl'.format(data_path=data_path,
+                                                           file_name=box_score_record_pickle_file_name),
+                      'rb') as f:
+                game_links_searched = pickle.load(f)
+
+            box_office_links = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_link_table_name), sep = '|')
+            box_office_details = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=box_score_details_table_name), sep = '|')
+            player_box_office_details = pd.read_csv('{data_path}/{db_name}.csv'.format(data_path=data_path, db_name=player_detail_table_name), sep = '|')
+            box_office_details.columns = [i.replace('stat_', '') for i in box_office_details.columns]
+        except FileNotFoundError:
+            return
         except:
             traceback.print_exc()
+            return
+
+        print('importing legacy scrape files into {}'.format(self.store.db_path))
+        self.store.save([(box_score_link_table_name, box_office_links.drop_duplicates(), ['box_score_url']),
+                         (box_score_details_table_name, box_office_details.drop_duplicates(), [c for c in ['box_score_url', 'team_tag', 'year', 'month', 'day'] if c in box_office_details.columns]),
+                         (player_detail_table_name, player_box_office_details.drop_duplicates(), [c for c in ['box_score_url', 'player_link', 'year', 'month', 'day'] if c in player_box_office_details.columns])],
+                        dates_searched_for_links,
+                        game_links_searched)
+
+    @timeit
+    def export_csv(self):
+        export_store_csv(self.store)
+
+    def mark_date_searched(self, date_str):
+        self.dates_searched_for_links.add(date_str)
+        self.unsaved_dates_searched_for_links.append(date_str)
+
+    def mark_game_searched(self, box_score_url):
+        self.game_links_searched.add(box_score_url)
+        self.unsaved_game_links_searched.append(box_score_url)
+
+    def queue_pending_box_score_links(self, game_links):
+        queued_links = {i['box_score_url'] for i in self.pending_box_score_links}
+        for i in game_links:
+            if i['box_score_url'] in self.game_links_searched or i['box_score_url'] in queued_links:
+                continue
+            queued_links.add(i['box_score_url'])
+            self.pending_box_score_links.append(i)
 
     def scrape_current_day_boxscore_links(self):
         for i in range(max_tries):
@@ -169,7 +368,7 @@ class Scraper:
                                            day = padded_day,
                                            year = padded_year)
                 print('scraping links from {}'.format(url))
-                soup = get_soup(url, session = self.session)
+                soup = get_soup(url, session = self.session, rate_limiter = self.rate_limiter)
                 games = soup.find_all('p', {'class': 'links'})
                 for i in games:
                     links = i.find_all('a')
@@ -177,9 +376,8 @@ class Scraper:
                     for j in days_games_box_score_links:
                         game_links.append({'box_score_url': j, 'year':padded_year, 'month':padded_month, 'day':padded_day})
 
-                new_df = pd.DataFrame.from_dict(game_links)
-                self.box_office_links = pd.concat([new_df, self.box_office_links])
-                self.box_office_links = self.box_office_links.drop_duplicates()
+                self.box_office_links.extend(game_links)
+                self.queue_pending_box_score_links(game_links)
                 break
             except:
                 traceback.print_exc()
@@ -191,16 +389,17 @@ class Scraper:
                 team_data = []
                 player_data = []
 
-                soup = get_soup(url, session=self.session)
-                soup = BeautifulSoup(str(soup).replace('-->', '').replace('<!--', ''), 'lxml')
+                tree = get_page_tree(url, session=self.session, rate_limiter=self.rate_limiter)
 
-                score_box = soup.find('div', {'class': 'scorebox'})
-                score_box_divs = score_box.find_all('div', recursive = False)
+                score_box = get_elements_by_class(tree, 'scorebox')[0]
+                score_box_divs = score_box.xpath('./div')
                 team_1 = score_box_divs[0]
                 team_2 = score_box_divs[1]
 
-                team_1_link = team_1.find('a', {'itemprop':'name'})['href']
-                team_2_link = team_2.find('a', {'itemprop':'name'})['href']
+                team_1_name_a = team_1.xpath('.//a[@itemprop="name"]')[0]
+                team_2_name_a = team_2.xpath('.//a[@itemprop="name"]')[0]
+                team_1_link = team_1_name_a.get('href')
+                team_2_link = team_2_name_a.get('href')
 
                 team_1_tag = team_1_link.split('/')[2].lower()
                 team_2_tag = team_2_link.split('/')[2].lower()
@@ -208,24 +407,23 @@ class Scraper:
                 team_1_link = base_url + team_1_link
                 team_2_link = base_url + team_2_link
 
-                team_1_name = team_1.find('a', {'itemprop': 'name'}).get_text()
-                team_2_name = team_2.find('a', {'itemprop': 'name'}).get_text()
+                team_1_name = team_1_name_a.text_content()
+                team_2_name = team_2_name_a.text_content()
 
-                scorebox_meta = soup.find('div', {'class': 'scorebox_meta'}).find_all('div')
-                location = scorebox_meta[1].get_text()
+                scorebox_meta = get_elements_by_class(tree, 'scorebox_meta')[0].xpath('.//div')
+                location = scorebox_meta[1].text_content()
 
-                data_tables = soup.find_all('table', {'class':'sortable stats_table'})
-                # print(data_tables)
-                team_1_basic_table = get_score_table(soup, team_1_tag, 'basic')
-                team_1_advanced_table = get_score_table(soup, team_1_tag, 'advanced')
-                team_2_basic_table = get_score_table(soup, team_2_tag, 'basic')
-                team_2_advanced_table = get_score_table(soup, team_2_tag, 'advanced')
+                team_1_basic_table = get_score_table(tree, team_1_tag, 'basic')
+                team_1_advanced_table = get_score_table(tree, team_1_tag, 'advanced')
+                team_2_basic_table = get_score_table(tree, team_2_tag, 'basic')
+                team_2_advanced_table = get_score_table(tree, team_2_tag, 'advanced')
 
                 t1_data = process_stats_tables(team_1_basic_table, team_1_advanced_table)
                 t2_data = process_stats_tables(team_2_basic_table, team_2_advanced_table)
 
                 team_1_data_self = {str(i): j for i, j in t1_data['team_data'].items()}
                 t1_base_data = {
+                                'box_score_url':url,
                                 'team_tag':team_1_tag,
                                 'team_link':team_1_link,
                                 'team_name':team_1_name,
@@ -242,6 +440,7 @@ class Scraper:
 
                 team_2_data_self = {str(i): j for i, j in t2_data['team_data'].items()}
                 t2_base_data = {
+                                'box_score_url':url,
                                 'team_tag':team_2_tag,
                                 'team_link':team_2_link,
                                 'team_name':team_2_name,
@@ -273,13 +472,8 @@ class Scraper:
                 team_data.append(t1_base_data)
                 team_data.append(t2_base_data)
 
-                new_df = pd.DataFrame.from_dict(team_data)
-                self.box_office_details = pd.concat([new_df, self.box_office_details])
-                self.box_office_details = self.box_office_details.drop_duplicates()
-
-                new_df = pd.DataFrame.from_dict(player_data)
-                self.player_box_office_details = pd.concat([new_df, self.player_box_office_details], sort = True)
-                self.player_box_office_details = self.player_box_office_details.drop_duplicates()
+                self.box_office_details.extend(team_data)
+                self.player_box_office_details.extend(player_data)
                 break
             except:
                 traceback.print_exc()
@@ -291,26 +485,27 @@ class Scraper:
             if str(self.current_date) in self.dates_searched_for_links:
                 continue
             self.scrape_current_day_boxscore_links()
-            self.dates_searched_for_links.append(str(self.current_date))
+            self.mark_date_searched(str(self.current_date))
 
 
     def scrape_all_box_office_details(self):
-        for _, i in self.box_office_links.iterrows():
+        while self.pending_box_score_links:
+            i = self.pending_box_score_links.popleft()
             if i['box_score_url'] in self.game_links_searched:
                 continue
             print('scraping game: {}'.format(i['box_score_url']))
             self.scrape_box_office_details(i['box_score_url'], i['year'], i['month'], i['day'])
-            self.game_links_searched.append(i['box_score_url'])
+            self.mark_game_searched(i['box_score_url'])
 
 
-    def scrape_date_range_boxscore_links_and_details(self):
+    def scrape_date_range_boxscore_links_and_details(self, export = True):
         counter = 0
         while self.current_date <= self.end_date and self.current_date >= self.start_date:
             self.current_date -= datetime.timedelta(days=1)
             if str(self.current_date) in self.dates_searched_for_links:
                 continue
             self.scrape_current_day_boxscore_links()
-            self.dates_searched_for_links.append(str(self.current_date))
+            self.mark_date_searched(str(self.current_date))
             self.scrape_all_box_office_details()
 
             counter += 1
@@ -319,6 +514,64 @@ class Scraper:
             if counter % self.save_frequency == 0:
                 self.save_data()
         self.save_data()
+        if export:
+            self.export_csv()
+
+
+def scrape_season(season, start_date, end_date, save_frequency, rate_limiter):
+    shard_folder = '{data_path}/{folder_name}'.format(data_path=data_path, folder_name=season_shard_folder_name)
+    os.makedirs(shard_folder, exist_ok=True)
+    # the scraper steps back a day before each scrape, so start one day later to include end_date
+    scraper = Scraper(start_date=start_date,
+                      end_date=end_date + datetime.timedelta(days=1),
+                      save_frequency=save_frequency,
+                      db_path='{shard_folder}/{season}.db'.format(shard_folder=shard_folder, season=season),
+                      rate_limiter=rate_limiter)
+    scraper.scrape_date_range_boxscore_links_and_details(export=False)
+    return scraper.store
+
+
+@timeit
+def scrape_seasons_in_parallel(start_date = None, end_date = None, max_workers = 4, requests_per_second = 2.0,
+                               save_frequency = 10):
+    '''
+    Backfills box scores one season per worker, each writing to its own shard store, with every worker sharing one
+    request budget. Finished shards are merged into the main store. Seasons that are over and were merged over their
+    whole August to July range are skipped, so adding an older season only scrapes that season.
+    '''
+    if not start_date:
+        start_date = datetime.date(1980, 1, 1)
+    if not end_date:
+        end_date = datetime.date.today()
+
+    store = ScrapeStore('{data_path}/{file_name}.db'.format(data_path=data_path, file_name=scrape_journal_file_name))
+    merged_seasons = store.load_values(store.seasons_table_name, 'season')
+    rate_limiter = RateLimiter(requests_per_second)
+    today = datetime.date.today()
+
+    season_ranges = [i for i in get_season_date_ranges(start_date, end_date) if str(i[0]) not in merged_seasons]
+    print('scraping seasons: {}'.format([i[0] for i in season_ranges]))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(scrape_season, season, season_start, season_end, save_frequency, rate_limiter):
+                       (season, season_start, season_end) for season, season_start, season_end in season_ranges}
+        for future in as_completed(futures):
+            season, season_start, season_end = futures[future]
+            try:
+                shard_store = future.result()
+            except:
+                traceback.print_exc()
+                continue
+            # only a season scraped from its first to its last day is recorded, a partial range is scraped again
+            season_finished = season_start <= datetime.date(season - 1, 8, 1) and \
+                season_end >= datetime.date(season, 7, 31) and season_end < today
+            with file_lock:
+                store.merge(shard_store, table_key_columns, season=season if season_finished else None)
+            shard_store.close()
+            print('merged season: {}'.format(season))
+
+    export_store_csv(store)
+    store.close()
 
 
 if __name__ == '__main__':
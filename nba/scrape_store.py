@@ -0,0 +1,114 @@
+import sqlite3
+import pandas as pd
+
+
+class ScrapeStore:
+    '''
+    Append-only SQLite store (WAL journal) for the box score scraper.
+
+    Each save only inserts the rows scraped since the previous save, inside one transaction, so a crash leaves the
+    store at the last committed save. Detail tables get new columns added as new stat names show up, and rows are
+    deduplicated by a unique index on the key columns.
+    '''
+    dates_table_name = 'scraped_dates'
+    games_table_name = 'scraped_games'
+    seasons_table_name = 'merged_seasons'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{self.dates_table_name}" (date TEXT PRIMARY KEY)')
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.games_table_name}" (box_score_url TEXT PRIMARY KEY)')
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{self.seasons_table_name}" (season TEXT PRIMARY KEY)')
+
+    def table_exists(self, table_name):
+        cursor = self.connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                                         (table_name,))
+        return cursor.fetchone() is not None
+
+    def get_columns(self, table_name):
+        return [i[1] for i in self.connection.execute(f'PRAGMA table_info("{table_name}")')]
+
+    def ensure_table(self, table_name, columns, key_columns):
+        if not self.table_exists(table_name):
+            key_sql = ', '.join([f'"{c}"' for c in key_columns])
+            self.connection.execute(f'CREATE TABLE "{table_name}" ({key_sql})')
+            self.connection.execute(f'CREATE UNIQUE INDEX "{table_name}_key" ON "{table_name}" ({key_sql})')
+
+        existing_columns = set(self.get_columns(table_name))
+        for c in columns:
+            if c not in existing_columns:
+                self.connection.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "{c}"')
+                existing_columns.add(c)
+
+    def insert_values(self, table_name, column, values):
+        self.connection.executemany(f'INSERT OR IGNORE INTO "{table_name}" ("{column}") VALUES (?)',
+                                    [(i,) for i in values])
+
+    def insert_frame(self, table_name, df, key_columns):
+        if df.empty:
+            return
+        columns = [str(c) for c in df.columns]
+        self.ensure_table(table_name, columns, key_columns)
+        column_sql = ', '.join([f'"{c}"' for c in columns])
+        value_sql = ', '.join(['?' for _ in columns])
+        values = df.astype(object).where(df.notna(), None).values.tolist()
+        self.connection.executemany(f'INSERT OR IGNORE INTO "{table_name}" ({column_sql}) VALUES ({value_sql})',
+                                    values)
+
+    def save(self, frames, dates, games):
+        '''
+        :param frames: list of (table_name, DataFrame, key_columns) holding only new rows
+        :param dates: newly searched dates
+        :param games: newly scraped box score urls
+        '''
+        with self.connection:
+            for table_name, df, key_columns in frames:
+                self.insert_frame(table_name, df, key_columns)
+            self.insert_values(self.dates_table_name, 'date', dates)
+            self.insert_values(self.games_table_name, 'box_score_url', games)
+
+    def merge(self, other, table_key_columns, season = None):
+        '''
+        Copies every row of another store into this one, optionally recording the season as merged.
+
+        :param other: ScrapeStore to read from
+        :param table_key_columns: dict of detail table name to its key columns
+        :param season: season label to record once the merge is committed
+        '''
+        frames = [(t, other.load_frame(t), k) for t, k in table_key_columns.items()]
+        self.save(frames,
+                  other.load_values(other.dates_table_name, 'date'),
+                  other.load_values(other.games_table_name, 'box_score_url'))
+        if season is not None:
+            with self.connection:
+                self.insert_values(self.seasons_table_name, 'season', [str(season)])
+
+    def load_values(self, table_name, column):
+        return {i[0] for i in self.connection.execute(f'SELECT "{column}" FROM "{table_name}"')}
+
+    def load_frame(self, table_name, query=None, params=()):
+        if not self.table_exists(table_name):
+            return pd.DataFrame()
+        if not query:
+            query = f'SELECT * FROM "{table_name}"'
+        return pd.read_sql_query(query, self.connection, params=params)
+
+    def is_empty(self):
+        for t in [self.dates_table_name, self.games_table_name]:
+            if self.connection.execute(f'SELECT 1 FROM "{t}" LIMIT 1').fetchone():
+                return False
+        return True
+
+    def clear(self):
+        tables = [i[0] for i in self.connection.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        with self.connection:
+            for t in tables:
+                self.connection.execute(f'DELETE FROM "{t}"')
+
+    def close(self):
+        self.connection.close()